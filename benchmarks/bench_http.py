@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Benchmark - the in-process HTTP download plugin
+
+Serves --files files from a local twisted.web server, every one
+of them named file.bin in a folder of its own, and downloads them
+all with HttpDownload alone. Files of at least --segment-min-size
+bytes are fetched in segments. The run checks that:
+
+* each url got a file of its own, with a numeric suffix for the
+  names already taken, and the content of one of the served files
+* no .part file or sidecar is left behind
+
+and reports the download rate and latency percentiles.
+
+    $ python benchmarks/bench_http.py --files 200 --size 1048576
+"""
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+import os, sys, argparse, hashlib, shutil, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from common import latency, peak_rss, temp_home
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='dman http benchmark')
+    parser.add_argument('--files', type=int, default=100)
+    parser.add_argument('--size', type=int, default=256 * 1024,
+            help='bytes per file')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--segment-min-size', type=int, default=1024 * 1024,
+            help='http_segment_min_size')
+    return parser.parse_args()
+
+def serve(args, root):
+    "Write the files to serve, returns their sha256 digests"
+    digests = []
+    for idx in range(args.files):
+        folder = os.path.join(root, '%d' % idx)
+        os.mkdir(folder)
+        data = os.urandom(args.size)
+        with open(os.path.join(folder, 'file.bin'), 'wb') as fileobj:
+            fileobj.write(data)
+        digests.append(hashlib.sha256(data).hexdigest())
+    return digests
+
+def check(out, digests):
+    "Returns the problems found in the downloaded files"
+    problems = []
+    names = sorted(os.listdir(out))
+    leftovers = [ name for name in names if '.part' in name ]
+    if leftovers:
+        problems.append('left behind: %s' % ', '.join(leftovers))
+    found = []
+    for name in names:
+        if name not in leftovers:
+            with open(os.path.join(out, name), 'rb') as fileobj:
+                found.append(hashlib.sha256(fileobj.read()).hexdigest())
+    if sorted(found) != sorted(digests):
+        problems.append('%d files for %d urls, %d with the served content'
+                % (len(found), len(digests), len(set(found) & set(digests))))
+    return problems
+
+def main():
+    "Run the benchmark"
+    args = parse_args()
+    tmp = temp_home({'maxdownloads': args.concurrency, 'maxdownloads_per_host': 0,
+        'journal_file': '', 'history_size': args.files,
+        'http_pool_size': args.concurrency,
+        'http_segment_min_size': args.segment_min_size})
+    try:
+        from twisted.internet import reactor
+        from twisted.web import server as web, static
+        from dman import server, plugins
+
+        root, out = os.path.join(tmp, 'www'), os.path.join(tmp, 'out')
+        os.mkdir(root)
+        os.mkdir(out)
+        digests = serve(args, root)
+        port = reactor.listenTCP(0, web.Site(static.File(root)),
+                interface='127.0.0.1')
+        plugins.REGISTRY.plugins = [plugins.HttpDownload]
+
+        dman = server.DMan()
+        state = {}
+
+        def done():
+            if dman.entries:
+                reactor.callLater(0.1, done)
+                return
+            state['end'] = time.time()
+            reactor.stop()
+
+        def begin():
+            state['start'] = time.time()
+            dman.download_many([ 'http://127.0.0.1:%d/%d/file.bin'
+                % (port.getHost().port, idx) for idx in range(args.files) ], out)
+            reactor.callLater(0.1, done)
+
+        reactor.callWhenRunning(begin)
+        reactor.run()
+        dman.close()
+
+        records = dman.finished.slice(0)
+        failed = [ record for record in records if not record.succeeded ]
+        elapsed = state['end'] - state['start']
+        print('%d downloads in %.1fs, %.1f MiB/s, %d failed' % (len(records),
+            elapsed, args.files * args.size / elapsed / (1024 * 1024),
+            len(failed)))
+        print(latency('started to finish',
+            [ record.finished - record.started for record in records
+                if record.started ]))
+        print('peak rss %.1f MiB' % peak_rss())
+        problems = check(out, digests)
+        for problem in problems:
+            print('error: %s' % problem)
+        if problems or failed:
+            sys.exit(1)
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Benchmark - client cold start
+
+Measures the time a fresh interpreter takes to import the
+client, against an empty interpreter. Importing the client
+must not pull in twisted or the plugins.
+
+    $ python benchmarks/bench_import.py [RUNS]
+"""
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+import os, sys, subprocess, time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+CASES = [
+    ('python', 'pass'),
+    ('dman.client', 'import dman.client'),
+]
+
+CHECK = ('import sys, dman.client;'
+        'sys.exit(any(m.startswith(("twisted", "dman.plugins", "dman.server"))'
+        ' for m in sys.modules))')
+
+def cold_start(code, runs):
+    "Return the per run timings of code in new interpreters"
+    timings = []
+    for _ in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', code], cwd=ROOT)
+        timings.append(time.time() - start)
+    return sorted(timings)
+
+def main():
+    "Run the benchmark"
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    if subprocess.call([sys.executable, '-c', CHECK], cwd=ROOT):
+        print('dman.client imports twisted or the server modules')
+        sys.exit(1)
+
+    for name, code in CASES:
+        timings = cold_start(code, runs)
+        print('%-12s min %6.1fms median %6.1fms'
+                % (name, timings[0] * 1000, timings[len(timings) // 2] * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Benchmark - urldrop ingest
+
+Runs DMan and the urldrop socket in this process, the dman
+client sends COUNT urls from a file (dman -i) and the benchmark
+ends once all of them are queued. No download is started, the journal
+and dedup index are enabled as in the daemon.
+
+Besides the urls/sec it reports the reactor lag, how late a
+10ms timer fires while the urls come in, i.e. how long other
+clients would wait for an answer.
+
+    $ python benchmarks/bench_ingest.py [COUNT]
+"""
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+import os, sys, shutil, subprocess, time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from common import latency, peak_rss, temp_home
+
+INTERVAL = 0.01
+
+def main():
+    "Run the benchmark"
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    tmp = temp_home({'maxdownloads': 0, 'pending_high_watermark': 0})
+    try:
+        from twisted.internet import reactor
+        from dman import server, client
+
+        dman = server.DMan()
+        reactor.listenUNIX(client.urldrop_path(), server.UrlDropFactory(dman))
+        path = os.path.join(tmp, 'urls.txt')
+        with open(path, 'wb') as fileobj:
+            fileobj.writelines(b'http://example.com/files/%d.tar.gz\n' % i
+                    for i in range(count))
+        lags = []
+        times = {}
+        sender = []
+
+        def check(expected):
+            now = time.time()
+            lags.append(now - expected)
+            if 'sent' not in times and sender[0].poll() is not None:
+                times['sent'] = now
+            if len(dman.entries) >= count:
+                times['queued'] = now
+                reactor.stop()
+            else:
+                reactor.callLater(INTERVAL, check, now + INTERVAL)
+
+        def begin():
+            times['start'] = time.time()
+            sender.append(subprocess.Popen([sys.executable, '-c',
+                'from dman import client; client.main()', '-i', path], cwd=ROOT))
+            reactor.callLater(INTERVAL, check, times['start'] + INTERVAL)
+
+        reactor.callWhenRunning(begin)
+        reactor.run()
+        sender[0].wait()
+        dman.close()
+
+        elapsed = times['queued'] - times['start']
+        print('%d urls queued in %.3fs, %.0f urls/sec (sent in %.3fs)'
+                % (count, elapsed, count / elapsed,
+                    times.get('sent', times['queued']) - times['start']))
+        print(latency('reactor lag', lags))
+        print('peak rss %.1f MiB' % peak_rss())
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Benchmark - netstring encoding and parsing
+
+Measures encode(), encode_many() and NetStringReader.feed()
+throughput for COUNT urls. The stream is fed in 64KiB chunks,
+as the urldrop socket delivers it.
+
+    $ python benchmarks/bench_netstring.py [COUNT]
+"""
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from common import peak_rss
+
+CHUNK = 64 * 1024
+
+def measure(name, func, count, size):
+    "Run func once and print its throughput"
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    print('%-20s %8.3fs %12.0f strings/sec %8.1f MB/sec'
+            % (name, elapsed, count / elapsed, size / elapsed / 1e6))
+
+def main():
+    "Run the benchmark"
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    from dman.netstring import encode, encode_many, NetStringReader
+
+    urls = [b'http://example.com/files/%d.tar.gz' % i for i in range(count)]
+    data = encode_many(urls)
+    chunks = [ data[i:i + CHUNK] for i in range(0, len(data), CHUNK) ]
+
+    class Reader(NetStringReader):
+        received = 0
+        def stringsReceived(self, strings):
+            self.received += len(strings)
+
+    def parse():
+        reader = Reader(max_length=64 * 1024)
+        for chunk in chunks:
+            reader.feed(chunk)
+        assert reader.received == count
+
+    measure('encode', lambda: [ encode(url) for url in urls ], count, len(data))
+    measure('encode_many', lambda: encode_many(urls), count, len(data))
+    measure('feed', parse, count, len(data))
+    print('peak rss %.1f MiB' % peak_rss())
+
+if __name__ == '__main__':
+    main()
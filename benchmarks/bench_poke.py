@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Benchmark - DMan.poke() scheduling cost
+
+Queues COUNT urls over 1000 hosts, with a download plugin that
+does nothing, then measures:
+
+* queue: download_many() for all the urls
+* full: poke() while every download slot is taken
+* turnover: a download finishing, download_finished() starts the
+  next one from the pending queue
+
+Each size runs in its own process, so the peak RSS is its own.
+The journal and dedup index are disabled, this is the scheduler
+alone.
+
+    $ python benchmarks/bench_poke.py [COUNT ...]
+"""
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+import os, sys, shutil, subprocess, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from common import latency, peak_rss, temp_home
+
+SIZES = [1000, 10000, 100000, 1000000]
+SLOTS = 64
+SAMPLES = 5000
+
+def run(count):
+    "Benchmark a single queue size"
+    tmp = temp_home({'maxdownloads': SLOTS, 'journal_file': '', 'dedup': 'force',
+        'pending_high_watermark': 0, 'history_size': SAMPLES})
+    try:
+        from dman import server, plugins
+
+        class NullDownload(plugins.Download):
+            "Never finishes on its own, see finish()"
+            code = None
+            def start(self):
+                return True
+            def stop(self):
+                self.finish(1)
+            def started(self):
+                return True
+            def finished(self):
+                return self.code is not None
+            def succeeded(self):
+                return self.code == 0
+            def error(self):
+                return ''
+            def finish(self, code=0):
+                self.code = code
+                self.dman.download_finished(self)
+            @staticmethod
+            def plugin_available():
+                return True
+        plugins.REGISTRY.plugins = [NullDownload]
+
+        dman = server.DMan()
+        urls = [ 'http://host%d.example.com/file/%d' % (i % 1000, i)
+                for i in range(count) ]
+        start = time.time()
+        dman.download_many(urls)
+        queued = time.time() - start
+        del urls
+
+        full = []
+        for _ in range(SAMPLES):
+            start = time.time()
+            dman.poke()
+            full.append(time.time() - start)
+
+        turnover = []
+        for _ in range(min(SAMPLES, count - SLOTS)):
+            download = next(iter(dman.downloading))
+            start = time.time()
+            download.finish()
+            turnover.append(time.time() - start)
+
+        print('%8d urls queued in %.3fs (%.0f urls/sec), peak rss %.1f MiB'
+                % (count, queued, count / queued, peak_rss()))
+        print('    ' + latency('full', full))
+        print('    ' + latency('turnover', turnover))
+    finally:
+        shutil.rmtree(tmp)
+
+def main():
+    "Run the benchmark"
+    if len(sys.argv) == 3 and sys.argv[1] == '--run':
+        run(int(sys.argv[2]))
+        return
+    sizes = [ int(arg) for arg in sys.argv[1:] ] or SIZES
+    for count in sizes:
+        subprocess.check_call([sys.executable, __file__, '--run', str(count)])
+
+if __name__ == '__main__':
+    main()
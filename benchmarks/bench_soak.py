@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Soak test - thousands of simulated downloads end to end
+
+Runs DMan with the real reactor, journal and dedup index, and a
+SimDownload plugin: a ProcessDownload that spawns
+
+    sh -c 'sleep <duration>; exit <code>'
+
+for sim:// urls. Durations are spread around --duration and a
+share of the downloads fail with a transient (wget's 4, retried)
+or a permanent (8) exit code. The test ends once every url is
+finished and reports:
+
+* queue to finish and process latency percentiles
+* the reactor lag, how late a 100ms timer fired
+* process exit codes and the peak running downloads
+* peak RSS of dman and of the largest child
+
+    $ python benchmarks/bench_soak.py --downloads 20000 --concurrency 1000
+"""
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+import os, sys, argparse, random, resource, shutil, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from common import latency, peak_rss, temp_home
+
+INTERVAL = 0.1
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='dman soak test')
+    parser.add_argument('--downloads', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--hosts', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=2.0,
+            help='mean download seconds')
+    parser.add_argument('--jitter', type=float, default=0.5,
+            help='durations vary by this fraction of --duration')
+    parser.add_argument('--transient', type=float, default=0.02,
+            help='share of attempts exiting with 4')
+    parser.add_argument('--fatal', type=float, default=0.01,
+            help='share of attempts exiting with 8')
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args()
+
+def raise_fd_limit(needed):
+    "Each download process holds 3 pipes, raise the open files limit"
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        target = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        if target < needed:
+            print('warning: only %d open files allowed, lower --concurrency'
+                    % target)
+
+def main():
+    "Run the soak test"
+    args = parse_args()
+    random.seed(args.seed)
+    raise_fd_limit(args.concurrency * 8 + 1024)
+    tmp = temp_home({'maxdownloads': args.concurrency, 'pending_high_watermark': 0,
+        'history_size': args.downloads, 'retry_delay': 0.5,
+        'retry_max_delay': 5})
+    try:
+        from twisted.internet import reactor
+        from dman import server, plugins
+
+        class SimDownload(plugins.ProcessDownload):
+            "A download that sleeps and exits with a random code"
+            errors = plugins.WGetDownload.errors
+            retriable = plugins.WGetDownload.retriable
+            executable = 'sh'
+            schemes = ('sim',)
+
+            @classmethod
+            def plugin_available(cls):
+                return plugins.which(cls.executable) is not None
+            def download_cmd(self):
+                duration = args.duration * (1 + random.uniform(-args.jitter,
+                    args.jitter))
+                chance = random.random()
+                if chance < args.transient:
+                    code = 4
+                elif chance < args.transient + args.fatal:
+                    code = 8
+                else:
+                    code = 0
+                return [plugins.which(self.executable), '-c',
+                        'sleep %.3f; exit %d' % (max(0, duration), code)]
+        plugins.REGISTRY.plugins = [SimDownload]
+
+        dman = server.DMan()
+        lags = []
+        state = {'peak': 0}
+
+        def check(expected):
+            now = time.time()
+            lags.append(now - expected)
+            state['peak'] = max(state['peak'], len(dman.downloading))
+            if not dman.entries:
+                state['end'] = now
+                reactor.stop()
+            else:
+                reactor.callLater(INTERVAL, check, now + INTERVAL)
+
+        def begin():
+            state['start'] = time.time()
+            dman.download_many([ 'sim://host%d/file%d' % (i % args.hosts, i)
+                for i in range(args.downloads) ])
+            reactor.callLater(INTERVAL, check, time.time() + INTERVAL)
+
+        reactor.callWhenRunning(begin)
+        reactor.run()
+        dman.close()
+
+        records = dman.finished.slice(0)
+        failed = sum(1 for record in records if not record.succeeded)
+        elapsed = state['end'] - state['start']
+        print('%d downloads in %.1fs, %.1f downloads/sec, %d failed, '
+                'peak %d running' % (len(records), elapsed,
+                    len(records) / elapsed, failed, state['peak']))
+        print(latency('queue to finish',
+            [ record.finished - record.queued for record in records ]))
+        print(latency('started to finish',
+            [ record.finished - record.started for record in records
+                if record.started ]))
+        print(latency('reactor lag', lags))
+        print('process exits: %s' % ', '.join('%s: %d' % item
+            for item in sorted(plugins.PROCESS_EXITS.values.items())))
+        print('peak rss %.1f MiB, largest child %.1f MiB'
+                % (peak_rss(), peak_rss(resource.RUSAGE_CHILDREN)))
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    main()
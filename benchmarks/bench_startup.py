@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Benchmark - daemon autostart latency
+
+Measures how long server.start_daemon() takes to return, i.e.
+until the urldrop socket accepts connections. Each run uses a
+temporary XDG_RUNTIME_DIR and HOME, the daemon is stopped with
+SIGTERM afterwards.
+
+    $ python benchmarks/bench_startup.py [RUNS]
+"""
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+import os, sys, signal, socket, shutil, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+def wait_exit(path, timeout=10):
+    "Wait for the daemon to remove its urldrop socket"
+    deadline = time.time() + timeout
+    while os.path.exists(path) and time.time() < deadline:
+        time.sleep(0.01)
+
+def main():
+    "Run the benchmark"
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    from dman import server
+
+    timings = []
+    for _ in range(runs):
+        tmp = tempfile.mkdtemp()
+        os.environ['XDG_RUNTIME_DIR'] = tmp
+        os.environ['HOME'] = tmp
+        try:
+            start = time.time()
+            pid = server.start_daemon()
+            elapsed = time.time() - start
+            if not pid:
+                print('the daemon failed to start')
+                sys.exit(1)
+
+            # The socket must accept connections right away
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(server.urldrop_path())
+            sock.close()
+            timings.append(elapsed)
+
+            os.kill(pid, signal.SIGTERM)
+            wait_exit(server.urldrop_path())
+        finally:
+            shutil.rmtree(tmp)
+
+    timings.sort()
+    print('start_daemon() min %6.1fms median %6.1fms max %6.1fms'
+            % (timings[0] * 1000, timings[len(timings) // 2] * 1000,
+                timings[-1] * 1000))
+
+if __name__ == '__main__':
+    main()
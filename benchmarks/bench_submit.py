@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Benchmark - submitting urls to the urldrop
+
+Compares the old one send() per url loop against
+client.dman_send_urls(). A thread drains a UNIX socket
+in a temporary XDG_RUNTIME_DIR, no daemon is needed.
+
+    $ python benchmarks/bench_submit.py [COUNT]
+"""
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+import os, sys, socket, shutil, tempfile, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+def drain(server):
+    "Accept connections and discard everything"
+    while True:
+        conn, _ = server.accept()
+        while conn.recv(1 << 16):
+            pass
+        conn.close()
+
+def send_loop(urls):
+    "The pre-batching client loop, one send() per url"
+    from dman.client import urldrop_path
+    from dman.netstring import encode
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(urldrop_path())
+    for url in urls:
+        sock.send(encode(url))
+    sock.close()
+
+def main():
+    "Run the benchmark"
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    tmp = tempfile.mkdtemp()
+    os.environ['XDG_RUNTIME_DIR'] = tmp
+    from dman import client
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(client.urldrop_path())
+    server.listen(5)
+    thread = threading.Thread(target=drain, args=(server,))
+    thread.daemon = True
+    thread.start()
+
+    urls = [b'http://example.com/files/%d.tar.gz' % i for i in range(count)]
+    try:
+        for name, func in (('send loop', send_loop),
+                           ('dman_send_urls', client.dman_send_urls)):
+            start = time.time()
+            func(urls)
+            elapsed = time.time() - start
+            print('%-16s %8d urls %8.3fs %12.0f urls/sec'
+                    % (name, count, elapsed, count / elapsed))
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    main()
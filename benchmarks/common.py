@@ -0,0 +1,46 @@
+# coding: utf-8
+"""Helpers shared by the benchmarks: a temporary dman home,
+latency percentiles and peak memory use"""
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+import os, resource, sys, tempfile
+
+def percentiles(values, points=(50, 90, 99)):
+    """Returns the given percentiles of values, nearest rank
+
+    >>> percentiles(range(1, 101))
+    [50, 90, 99]
+    """
+    values = sorted(values)
+    if not values:
+        return [ 0 for _ in points ]
+    return [ values[max(0, -(-len(values) * point // 100) - 1)]
+            for point in points ]
+
+def latency(name, timings):
+    "Format timings (seconds) as percentiles in ms"
+    p50, p90, p99 = percentiles(timings)
+    return ('%s p50 %.3fms p90 %.3fms p99 %.3fms max %.3fms'
+            % (name, p50 * 1000, p90 * 1000, p99 * 1000,
+                max(timings or [0]) * 1000))
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    "Returns the peak resident set size in MiB"
+    rss = resource.getrusage(who).ru_maxrss
+    # bytes on OS X, KiB elsewhere
+    if sys.platform == 'darwin':
+        return rss / (1024 * 1024)
+    return rss / 1024
+
+def temp_home(options):
+    """Point HOME and XDG_RUNTIME_DIR at a new temporary folder with
+    a dman.cfg holding options, returns the folder"""
+    tmp = tempfile.mkdtemp()
+    os.environ['HOME'] = tmp
+    os.environ['XDG_RUNTIME_DIR'] = tmp
+    os.mkdir(os.path.join(tmp, '.dman'))
+    with open(os.path.join(tmp, '.dman', 'dman.cfg'), 'w') as cfg:
+        cfg.write('[dman]\n')
+        for option, value in sorted(options.items()):
+            cfg.write('%s = %s\n' % (option, value))
+    return tmp
@@ -4,6 +4,12 @@ dman is a Meta-download manager
 
 * for client functions check the *client* module
 * the *server* module holds the server bits
+* the *paths* module holds the runtime paths shared by both
+* the *queues* module holds the download queues used by the server
+* the *adaptive* module tunes the number of concurrent downloads
+* the *bandwidth* module holds the download rate limits
+* the *verify* module checks downloaded files against their checksums
+* the *metrics* module holds the daemon counters and histograms
 * for netstring encoding/decoding check the *netstring* module
 * the *plugins* modules holds all download implementations,
   if you are thinking about implementing support for other
@@ -0,0 +1,81 @@
+# coding: utf-8
+"""
+dman - adaptive download concurrency
+
+The ConcurrencyController tunes the number of download slots
+from the aggregate throughput measured at fixed intervals. It
+follows AIMD: a slot is added while more slots bring more
+throughput, a probe that brought nothing is undone, and when
+the throughput drops the slots are cut multiplicatively.
+"""
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+import logging
+
+class ConcurrencyController(object):
+    """Choose the number of download slots, between min_slots and
+    max_slots, see update()
+
+    * gain: the relative throughput increase that justifies a slot
+    * loss: the relative throughput drop that triggers a decrease
+    * decrease: slots are multiplied by this on a decrease
+    * probe_after: after this many updates without changes a slot
+      is added, in case the network got faster
+
+    >>> ctl = ConcurrencyController(2, 1, 8)
+    >>> [ ctl.update(rate, True) for rate in (100, 150, 200, 205, 100) ]
+    [3, 4, 5, 4, 3]
+    >>> ctl.update(10, False)
+    3
+    """
+
+    def __init__(self, slots, min_slots=1, max_slots=16, gain=0.05,
+            loss=0.2, decrease=0.75, probe_after=6):
+        self.min_slots = min_slots
+        self.max_slots = max_slots
+        self.slots = max(min_slots, min(slots, max_slots))
+        self.gain = gain
+        self.loss = loss
+        self.decrease = decrease
+        self.probe_after = probe_after
+        self.last = None
+        self.__increased = False
+        self.__holds = 0
+
+    def update(self, throughput, busy):
+        """Feed the aggregate throughput (bytes/s) measured with the
+        current slots, returns the new number of slots
+
+        busy is False if the slots were not all in use, there is
+        nothing to learn from such a sample"""
+        if not busy:
+            self.last = None
+            self.__increased = False
+            return self.slots
+
+        last, self.last = self.last, throughput
+        slots = self.slots
+        if last is None or throughput > last * (1 + self.gain):
+            slots += 1
+            reason = 'throughput is growing'
+        elif throughput < last * (1 - self.loss):
+            slots = int(slots * self.decrease)
+            reason = 'throughput dropped'
+        elif self.__increased:
+            slots -= 1
+            reason = 'the last slot did not help'
+        elif self.__holds >= self.probe_after:
+            slots += 1
+            reason = 'probing'
+        else:
+            self.__holds += 1
+            return self.slots
+
+        slots = max(self.min_slots, min(slots, self.max_slots))
+        self.__increased = slots > self.slots
+        self.__holds = 0
+        if slots != self.slots:
+            logging.info('Adaptive concurrency: %.0f B/s with %d slots, %s, '
+                    'using %d slots' % (throughput, self.slots, reason, slots))
+            self.slots = slots
+        return self.slots
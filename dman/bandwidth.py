@@ -0,0 +1,117 @@
+# coding: utf-8
+"""
+dman - bandwidth budget
+
+BandwidthBudget holds the total rate limit, optionally set by
+time of day, DMan splits it across the running downloads and
+hands each share to the plugins (i.e. wget --limit-rate).
+TokenBucket throttles downloads that run inside dman.
+"""
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+import datetime
+import time
+
+RATE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+def parse_rate(text):
+    """Parse a rate in bytes/s, with an optional K, M or G suffix,
+    0 means no limit
+
+    >>> parse_rate('500K'), parse_rate('1.5M'), parse_rate('100')
+    (512000, 1572864, 100)
+    """
+    text = text.strip().upper()
+    unit = text[-1:] if text[-1:] in RATE_UNITS else ''
+    return int(float(text[:len(text) - len(unit)]) * RATE_UNITS[unit])
+
+def parse_minute(text):
+    "Parse HH:MM into minutes since midnight"
+    hours, _, minutes = text.strip().partition(':')
+    return int(hours) * 60 + int(minutes or 0)
+
+def parse_schedule(text):
+    """Parse a comma separated list of "HH:MM-HH:MM rate" periods,
+    periods may wrap around midnight
+
+    >>> parse_schedule('08:00-18:00 500K, 22:00-06:30 0')
+    [(480, 1080, 512000), (1320, 390, 0)]
+    """
+    schedule = []
+    for period in text.split(','):
+        if not period.strip():
+            continue
+        times, rate = period.split()
+        start, end = times.split('-')
+        schedule.append((parse_minute(start), parse_minute(end), parse_rate(rate)))
+    return schedule
+
+class BandwidthBudget(object):
+    """The total download rate limit
+
+    The first schedule period that contains the current time
+    sets the limit, outside all periods max_rate applies.
+
+    >>> budget = BandwidthBudget(1000, parse_schedule('22:00-06:00 0'))
+    >>> budget.limit(datetime.datetime(2020, 1, 1, 12)), budget.share(3)
+    (1000, 333)
+    >>> budget.limit(datetime.datetime(2020, 1, 1, 23))
+    0
+    >>> BandwidthBudget(1000).share(2, taken=800)
+    100
+    """
+
+    def __init__(self, max_rate=0, schedule=()):
+        self.max_rate = max_rate
+        self.schedule = list(schedule)
+
+    def limit(self, now=None):
+        "Returns the rate limit in bytes/s, 0 for none"
+        if not self.schedule:
+            return self.max_rate
+        now = now or datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.schedule:
+            if start <= end:
+                if start <= minute < end:
+                    return rate
+            elif minute >= start or minute < end:
+                return rate
+        return self.max_rate
+
+    def share(self, count, now=None, taken=0):
+        """Returns the limit for each of count downloads, 0 for none
+
+        taken is the rate already used by other downloads"""
+        limit = self.limit(now)
+        if not limit or not count:
+            return 0
+        return max(1, (limit - taken) // count)
+
+class TokenBucket(object):
+    """A token bucket, one token per byte
+
+    The bucket holds up to one second of tokens
+
+    >>> bucket = TokenBucket(100, now=0)
+    >>> bucket.consume(80, now=0), bucket.consume(70, now=0.1)
+    (0, 0.4)
+    """
+
+    def __init__(self, rate=0, now=None):
+        self.rate = rate
+        self.tokens = rate
+        self.stamp = time.time() if now is None else now
+
+    def consume(self, amount, now=None):
+        """Take amount tokens, returns the seconds to wait before
+        taking more (0 for none). A rate of 0 never waits"""
+        if not self.rate:
+            return 0
+        now = time.time() if now is None else now
+        self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
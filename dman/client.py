@@ -1,35 +1,123 @@
 # coding: utf-8
 """
 dman - client components
+
+This module must not import twisted or the plugins, it
+is loaded every time dman is called with urls
 """
 from __future__ import print_function, unicode_literals
 from __future__ import absolute_import, division
 import socket
-from .server import urldrop_path
-from .netstring import encode as netstring_encode
+import json
+from itertools import islice
+from .paths import urldrop_path, ipc_path
+from .netstring import encode_many as netstring_encode_many
+from .netstring import encode as netstring_encode, NetStringReader
 import sys
 
+# Number of urls encoded into a single buffer before it is sent
+BATCH_SIZE = 4096
+
+def iter_urls(fileobj):
+    """Yield urls read from a file object, one url per line
+
+    Empty lines and lines starting with # are skipped. The file
+    is read lazily so memory use does not depend on its size"""
+    for line in fileobj:
+        line = line.strip()
+        if line and not line.startswith(b'#'):
+            yield line
+
+def dman_send_urls(urls, batch_size=BATCH_SIZE):
+    """Send an iterable of URLs to the dman urldrop
+
+    Urls are encoded in batches of batch_size netstrings and each
+    batch is written with a single sendall(). Returns the number
+    of urls sent"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(urldrop_path())
+
+    count = 0
+    urls = iter(urls)
+    try:
+        while True:
+            batch = list(islice(urls, batch_size))
+            if not batch:
+                break
+            sock.sendall(netstring_encode_many(batch))
+            count += len(batch)
+    finally:
+        sock.close()
+    return count
+
 def dman_send_url(urls):
     """Send URLs to the dman urldrop
-    
+
     This method accepts a single argument, either a url string
     or a list of urls"""
+    if not isinstance(urls, list):
+        urls = [urls]
+    dman_send_urls(urls)
+
+def dman_rpc(calls):
+    """Call JSON-RPC methods in the daemon
+
+    calls is a list of (method, params) tuples, all calls are sent
+    as a single batch. Returns the list of response objects in the
+    same order as calls"""
+    batch = [ {'jsonrpc': '2.0', 'method': method, 'params': params, 'id': idx}
+            for idx, (method, params) in enumerate(calls) ]
+
     sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    sock.connect(urldrop_path())
+    sock.connect(ipc_path())
+    try:
+        sock.sendall(netstring_encode(json.dumps(batch)))
+        responses = []
+        reader = NetStringReader()
+        reader.stringReceived = responses.append
+        while not responses:
+            data = sock.recv(1 << 16)
+            if not data:
+                raise IOError('Connection closed by dman')
+            reader.feed(data)
+    finally:
+        sock.close()
 
-    if isinstance(urls, list):
-        for url in urls:
-            sock.send(netstring_encode(url))
-    else:
-        sock.send(netstring_encode(url))
-    sock.close()
+    responses = json.loads(responses[0])
+    if isinstance(responses, dict):
+        # The whole batch was rejected
+        return [responses] * len(calls)
+    responses.sort(key=lambda response: response.get('id'))
+    return responses
+
+def urls_from_args(args):
+    """Yield urls from program arguments
+
+    * -i FILE reads urls from FILE, one per line
+    * - reads urls from stdin, one per line
+    * anything else is a url
+    """
+    args = iter(args)
+    for arg in args:
+        if arg == '-':
+            for url in iter_urls(sys.stdin):
+                yield url
+        elif arg == '-i':
+            path = next(args, None)
+            if path is None:
+                break
+            with open(path, 'rb') as fileobj:
+                for url in iter_urls(fileobj):
+                    yield url
+        else:
+            yield arg
 
 def main():
     """The is the main() function for a simple
     urldrop ipc client.
 
     All program arguments are treated as urls and send to
-    the urldrop.
+    the urldrop, see urls_from_args() for reading urls from
+    stdin or a file.
     """
-    dman_send_url(sys.argv[1:])
-
+    dman_send_urls(urls_from_args(sys.argv[1:]))
@@ -0,0 +1,217 @@
+# coding: utf-8
+"""
+dman - duplicate url detection
+
+DedupIndex tracks normalized urls for queued, running and
+finished downloads. Recently finished urls are kept in a
+bounded dict, all finished urls also go into a BloomFilter
+so the long history is covered with a fixed amount of memory.
+
+The policy decides what happens to duplicates:
+
+* skip: duplicates are never downloaded
+* missing: finished urls are downloaded again if the file is
+  no longer on disk, queued or running urls are skipped
+* force: no deduplication
+"""
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+import posixpath
+import struct
+
+POLICIES = ('skip', 'missing', 'force')
+
+DEFAULT_PORTS = {'http': ':80', 'https': ':443', 'ftp': ':21'}
+
+def normalize_url(url):
+    """Normalize a url for duplicate detection
+
+    The scheme and host are lowercased, default ports and
+    fragments are dropped and an empty path becomes /
+
+    >>> print(normalize_url('HTTP://Example.COM:80?q=1#frag'))
+    http://example.com/?q=1
+    >>> print(normalize_url('https://User@Host:8443/A/b'))
+    https://User@host:8443/A/b
+    """
+    if isinstance(url, bytes):
+        url = url.decode('utf-8', 'replace')
+    start = url.find('://')
+    if start == -1:
+        return url
+    end = len(url)
+    for sep in '/?#':
+        idx = url.find(sep, start + 3, end)
+        if idx != -1:
+            end = idx
+
+    scheme = url[:start].lower()
+    userinfo, _, host = url[start + 3:end].rpartition('@')
+    host = host.lower()
+    port = DEFAULT_PORTS.get(scheme)
+    if port and host.endswith(port):
+        host = host[:-len(port)]
+    if userinfo:
+        host = userinfo + '@' + host
+
+    rest = url[end:].partition('#')[0]
+    if not rest.startswith('/'):
+        rest = '/' + rest
+    return scheme + '://' + host + rest
+
+def url_filename(url):
+    """Guess the name of the file a url is saved as
+
+    >>> print(url_filename('http://host/dir/file.tar.gz?x=1'))
+    file.tar.gz
+    >>> print(url_filename('host/file.iso'))
+    file.iso
+    """
+    if isinstance(url, bytes):
+        url = url.decode('utf-8', 'replace')
+    # Urls without a scheme are http, like wget
+    scheme, sep, rest = url.partition('://')
+    path = (rest if sep else url).partition('/')[2]
+    path = path.partition('?')[0].partition('#')[0]
+    return posixpath.basename(path) or 'index.html'
+
+class BloomFilter(object):
+    """A fixed size probabilistic set
+
+    Lookups may return false positives, never false negatives
+
+    >>> bloom = BloomFilter(1 << 16)
+    >>> bloom.add(b'http://host/a')
+    >>> b'http://host/a' in bloom, b'http://host/b' in bloom
+    (True, False)
+    """
+
+    def __init__(self, bits, hashes=7):
+        self.bits = bits
+        self.hashes = hashes
+        self.array = bytearray((bits + 7) // 8)
+
+    def __positions(self, key):
+        "The bit positions for key, using double hashing"
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        first, second = struct.unpack(b'<QQ', hashlib.md5(key).digest())
+        return [ (first + i * second) % self.bits for i in range(self.hashes) ]
+
+    def add(self, key):
+        "Add key to the filter"
+        array = self.array
+        for pos in self.__positions(key):
+            array[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        array = self.array
+        for pos in self.__positions(key):
+            if not array[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def load(self, path):
+        "Load the filter bits from path, if the file size matches"
+        try:
+            with open(path, 'rb') as fileobj:
+                data = fileobj.read()
+        except IOError:
+            return False
+        if len(data) != len(self.array):
+            logging.info('Ignoring %s, the filter size changed' % path)
+            return False
+        self.array = bytearray(data)
+        return True
+
+    def save(self, path):
+        "Save the filter bits into path"
+        tmp = path + '.tmp'
+        try:
+            folder = os.path.dirname(path)
+            if folder and not os.path.isdir(folder):
+                os.makedirs(folder)
+            with open(tmp, 'wb') as fileobj:
+                fileobj.write(self.array)
+            os.rename(tmp, path)
+        except (IOError, OSError) as ex:
+            logging.warning('Unable to save %s: %s' % (path, ex))
+
+class DedupIndex(object):
+    """The duplicate url index
+
+    * policy: one of POLICIES
+    * max_finished: number of finished urls kept in memory
+    * filter_bits: size of the bloom filter for older finished
+      urls, 0 disables the filter
+    * filter_path: file where the filter is saved by close()
+    """
+
+    def __init__(self, policy='skip', max_finished=1000, filter_bits=0,
+            filter_path=None):
+        if policy not in POLICIES:
+            raise ValueError('Unknown dedup policy: %s' % policy)
+        self.policy = policy
+        self.max_finished = max_finished
+        self.queued = {}
+        self.finished = OrderedDict()
+        self.filter = BloomFilter(filter_bits) if filter_bits else None
+        self.filter_path = filter_path
+        if self.filter and filter_path:
+            self.filter.load(filter_path)
+
+    def check(self, url, save_in):
+        """Check if url should be downloaded into save_in
+
+        Returns None if it should, otherwise the id of the queued
+        or finished download it duplicates (0 if the id is unknown)"""
+        if self.policy == 'force':
+            return None
+
+        key = normalize_url(url)
+        entry_id = self.queued.get(key)
+        if entry_id is not None:
+            return entry_id
+
+        entry_id = self.finished.get(key)
+        if entry_id is None and self.filter and key in self.filter:
+            entry_id = 0
+        if entry_id is None:
+            return None
+
+        if self.policy == 'missing' and \
+                not os.path.exists(os.path.join(save_in, url_filename(url))):
+            return None
+        return entry_id
+
+    def add(self, url, entry_id):
+        "Add a queued url"
+        if self.policy != 'force':
+            self.queued[normalize_url(url)] = entry_id
+
+    def finish(self, url, entry_id, succeeded):
+        """Move a url out of the queued urls, urls that were
+        downloaded successfully are added to the finished urls"""
+        if self.policy == 'force':
+            return
+        key = normalize_url(url)
+        if self.queued.get(key) == entry_id:
+            del self.queued[key]
+        if not succeeded:
+            return
+
+        self.finished.pop(key, None)
+        self.finished[key] = entry_id
+        if len(self.finished) > self.max_finished:
+            self.finished.popitem(last=False)
+        if self.filter:
+            self.filter.add(key)
+
+    def close(self):
+        "Save the bloom filter"
+        if self.filter and self.filter_path:
+            self.filter.save(self.filter_path)
@@ -0,0 +1,233 @@
+# coding: utf-8
+"""
+dman - finished download history
+
+Finished downloads are stored as small FinishedRecord tuples,
+only the most recent records are kept in memory. Older records
+are appended to a history file, one record per line:
+
+    <id>\t<json object>\n
+
+The file can still be queried, see History.get()
+"""
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+from array import array
+from bisect import bisect_left
+from collections import deque, namedtuple
+from itertools import islice
+import json
+import logging
+import os
+import time
+
+def to_text(value):
+    "Decode byte strings (i.e. urls from the urldrop) for json"
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+class FinishedRecord(namedtuple('FinishedRecord', ['id', 'url', 'save_in',
+        'priority', 'state', 'succeeded', 'returncode', 'error',
+        'queued', 'started', 'finished'])):
+    """A finished (or cancelled) download
+
+    Times are unix timestamps, started is None if the
+    download was cancelled before it started"""
+    __slots__ = ()
+
+    @classmethod
+    def from_entry(cls, entry, finished=None, error=None):
+        """Build a record from a QueueEntry, error is the reason
+        an entry without a download failed (default Cancelled)"""
+        download = entry.download
+        if download:
+            succeeded = download.succeeded()
+            returncode = download.returncode()
+            error = download.error()
+        else:
+            succeeded = False
+            returncode = None
+            error = error or 'Cancelled'
+        return cls(entry.id, entry.url, entry.save_in, entry.priority,
+                entry.state, succeeded, returncode, error,
+                entry.queued, entry.started, finished or time.time())
+
+    def status(self):
+        "Returns a dict describing this record, see QueueEntry.status()"
+        return dict((k, to_text(v)) for k, v in self._asdict().items())
+
+    def to_line(self):
+        "Serialize the record as a history file line"
+        return b'%d\t%s\n' % (self.id, json.dumps(self.status(),
+                sort_keys=True).encode('utf-8'))
+
+    @classmethod
+    def from_line(cls, line):
+        "Parse a line written by to_line()"
+        return cls(**json.loads(line.split(b'\t', 1)[1].decode('utf-8')))
+
+class History(object):
+    """The finished download history
+
+    At most max_records records, no older than max_age
+    seconds, are kept in memory. Older records go into the
+    history file at path. A limit of 0 disables it.
+
+    Records reach the file in the order they finished, roughly
+    by id. The file offset of each record is kept in arrays sorted
+    by id, a lookup is a bisect and a single line read.
+    """
+
+    def __init__(self, path=None, max_records=1000, max_age=0):
+        self.path = path
+        self.max_records = max_records
+        self.max_age = max_age
+        self.records = deque()
+        self.index = {}
+        self.spilled = 0
+        self.last_id = 0
+        # ids of the records in the file, sorted, and their offsets
+        self.file_ids = array(b'l')
+        self.file_offsets = array(b'l')
+        self.__size = 0
+        self.__file = None
+        self.__reader = None
+
+        if path:
+            self.__scan()
+
+    def __scan(self):
+        "Index the records in the history file and find the last id"
+        offsets = []
+        try:
+            with open(self.path, 'rb') as fileobj:
+                for line in fileobj:
+                    if line[-1:] != b'\n':
+                        # A partial line, written during a crash
+                        break
+                    try:
+                        offsets.append((int(line.split(b'\t', 1)[0]), self.__size))
+                    except ValueError:
+                        logging.warning('Invalid history record: %r' % line[:200])
+                    self.__size += len(line)
+        except IOError as ex:
+            logging.info('Unable to read history %s: %s' % (self.path, ex))
+        offsets.sort()
+        self.file_ids.extend(record_id for record_id, offset in offsets)
+        self.file_offsets.extend(offset for record_id, offset in offsets)
+        self.spilled = len(offsets)
+        if offsets:
+            self.last_id = offsets[-1][0]
+
+    def __len__(self):
+        return self.spilled + len(self.records)
+
+    def append(self, record):
+        "Add a record, spilling older records into the file"
+        self.records.append(record)
+        self.index[record.id] = record
+        self.last_id = max(self.last_id, record.id)
+        self.trim()
+
+    def trim(self, now=None):
+        "Move records over the count or age limits into the file"
+        now = now or time.time()
+        lines = []
+        while self.records and (
+                (self.max_records and len(self.records) > self.max_records) or
+                (self.max_age and self.records[0].finished < now - self.max_age)):
+            record = self.records.popleft()
+            del self.index[record.id]
+            lines.append(record)
+        if lines:
+            self.__spill(lines)
+
+    def __spill(self, records):
+        "Append records to the history file and index their offsets"
+        if not self.path:
+            return
+        lines = [ record.to_line() for record in records ]
+        try:
+            if not self.__file:
+                folder = os.path.dirname(self.path)
+                if folder and not os.path.isdir(folder):
+                    os.makedirs(folder)
+                self.__file = open(self.path, 'ab')
+                # Drop the partial line of a crash, offsets follow __size
+                self.__file.truncate(self.__size)
+            self.__file.writelines(lines)
+            self.__file.flush()
+        except (IOError, OSError) as ex:
+            logging.warning('Unable to write history %s: %s' % (self.path, ex))
+            return
+        for record, line in zip(records, lines):
+            # Near the end, records finish roughly in id order
+            idx = bisect_left(self.file_ids, record.id)
+            self.file_ids.insert(idx, record.id)
+            self.file_offsets.insert(idx, self.__size)
+            self.__size += len(line)
+        self.spilled += len(lines)
+
+    def __file_lines(self):
+        "Iterate the lines in the history file"
+        if not self.path or not self.spilled:
+            return
+        try:
+            with open(self.path, 'rb') as fileobj:
+                for line in fileobj:
+                    yield line
+        except IOError as ex:
+            logging.warning('Unable to read history %s: %s' % (self.path, ex))
+
+    def get(self, record_id):
+        """Returns the record for an id or None
+
+        Records in memory are found in O(1), records in the
+        history file in O(log n) and a single line read"""
+        record = self.index.get(record_id)
+        if record:
+            return record
+        if record_id > self.last_id:
+            return None
+
+        idx = bisect_left(self.file_ids, record_id)
+        if idx == len(self.file_ids) or self.file_ids[idx] != record_id:
+            return None
+        try:
+            if not self.__reader:
+                self.__reader = open(self.path, 'rb')
+            self.__reader.seek(self.file_offsets[idx])
+            return FinishedRecord.from_line(self.__reader.readline())
+        except (IOError, ValueError) as ex:
+            logging.warning('Unable to read history %s: %s' % (self.path, ex))
+            return None
+
+    def slice(self, start, stop=None):
+        """Returns the records from start to stop, oldest first
+
+        Only the selected lines in the history file are parsed"""
+        result = []
+        if start < self.spilled:
+            for idx, line in enumerate(self.__file_lines()):
+                if stop is not None and idx >= stop:
+                    break
+                if idx >= start:
+                    result.append(FinishedRecord.from_line(line))
+        start = max(0, start - self.spilled)
+        stop = None if stop is None else max(0, stop - self.spilled)
+        result.extend(islice(self.records, start, stop))
+        return result
+
+    def close(self):
+        "Move all records into the history file and close it"
+        if self.path and self.records:
+            self.__spill(list(self.records))
+            self.records.clear()
+            self.index.clear()
+        if self.__file:
+            self.__file.close()
+            self.__file = None
+        if self.__reader:
+            self.__reader.close()
+            self.__reader = None
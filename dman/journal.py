@@ -0,0 +1,238 @@
+# coding: utf-8
+"""
+dman - persistent queue journal
+
+The journal is an append-only file that records changes to
+the DMan queues so they can be rebuilt after a restart or a
+crash. Each line is a tab separated record:
+
+    a <id> <priority> <save_in> <url>    a url was queued
+    p <id> <priority>                    a url was reprioritized
+    s <id> <path>                        a download left a partial file
+    v <id> <size> <sha256>               the expected file, fields may be empty
+    d <id>                               a url finished or was cancelled
+
+Records are buffered and written in groups, each group is
+followed by a single fsync(). When the journal grows too
+large it is compacted: the live entries are written into a
+new file that atomically replaces the journal.
+
+Urls with an s record have a partial file on disk, after a
+restart their downloads continue it instead of starting over.
+"""
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+import logging
+import os
+
+def escape(value):
+    """Escape tabs and newlines in a journal field
+
+    >>> print(escape('a\\tb\\\\c'))
+    a\\tb\\\\c
+    >>> unescape(escape('a\\tb\\\\c\\n')) == 'a\\tb\\\\c\\n'
+    True
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    if b'\\' in value or b'\t' in value or b'\n' in value:
+        value = value.replace(b'\\', b'\\\\').replace(b'\t', b'\\t').replace(b'\n', b'\\n')
+    return value
+
+def unescape(value):
+    "Reverse escape()"
+    if b'\\' not in value:
+        return value
+    parts = value.split(b'\\\\')
+    return b'\\'.join(part.replace(b'\\t', b'\t').replace(b'\\n', b'\n')
+            for part in parts)
+
+def expected_record(entry):
+    "The v record for an entry with an expected file, or b''"
+    if not entry.expected:
+        return b''
+    size = entry.expected.get('size')
+    return b'v\t%d\t%s\t%s\n' % (entry.id,
+            b'' if size is None else b'%d' % size,
+            entry.expected.get('sha256', b''))
+
+def partial_record(entry):
+    "The s record for an entry with a partial file, or b''"
+    if not entry.partial:
+        return b''
+    return b's\t%d\t%s\n' % (entry.id, escape(entry.partial))
+
+class Journal(object):
+    """The DMan queue journal
+
+    * call_later: a function like reactor.callLater, used to
+      schedule group commits commit_interval seconds after
+      the first buffered record
+    * live_entries: returns the QueueEntry objects that are
+      still queued, used for compaction
+    """
+    # Compact once there are this many records and
+    # at least twice as many records as live entries
+    compact_min = 100000
+
+    def __init__(self, path, call_later, live_entries, commit_interval=0.1):
+        self.path = path
+        self.call_later = call_later
+        self.live_entries = live_entries
+        self.commit_interval = commit_interval
+        self.__buffer = []
+        self.__pending_commit = None
+        self.__file = None
+        self.records = 0
+
+    def replay(self):
+        """Read the journal, returns the list of live entries as
+        tuples (id, priority, save_in, url, partial, expected) sorted
+        by id, partial is the path of the partial file or None and
+        expected is None or a dict like QueueEntry.expected"""
+        entries = {}
+        self.records = 0
+        try:
+            fileobj = open(self.path, 'rb')
+        except IOError:
+            return []
+
+        records = 0
+        with fileobj:
+            for line in fileobj:
+                if line[-1:] != b'\n':
+                    # A partial record, written during a crash
+                    break
+                records += 1
+                fields = line[:-1].split(b'\t')
+                try:
+                    if fields[0] == b'a':
+                        if b'\\' in line:
+                            fields[3] = unescape(fields[3])
+                            fields[4] = unescape(fields[4])
+                        fields[2] = int(fields[2])
+                        fields[5:] = [None, None]
+                        entries[int(fields[1])] = fields
+                    elif fields[0] == b'd':
+                        entries.pop(int(fields[1]), None)
+                    elif fields[0] == b'p':
+                        entry = entries.get(int(fields[1]))
+                        if entry:
+                            entry[2] = int(fields[2])
+                    elif fields[0] == b's':
+                        entry = entries.get(int(fields[1]))
+                        if entry:
+                            # No path in older journals, start over
+                            entry[5] = unescape(fields[2]) if len(fields) > 2 \
+                                    and fields[2] else None
+                    elif fields[0] == b'v':
+                        entry = entries.get(int(fields[1]))
+                        if entry:
+                            entry[6] = expected = {}
+                            if fields[2]:
+                                expected['size'] = int(fields[2])
+                            if fields[3]:
+                                expected['sha256'] = fields[3]
+                except (IndexError, ValueError):
+                    logging.warning('Invalid journal record: %r' % line)
+        self.records = records
+
+        return [ (entry_id, live[2], live[3], live[4], live[5], live[6])
+                for entry_id, live in sorted(entries.iteritems()) ]
+
+    def __append(self, record):
+        "Buffer a record and schedule a group commit"
+        self.__buffer.append(record)
+        if not self.__pending_commit:
+            self.__pending_commit = self.call_later(self.commit_interval,
+                    self.commit)
+
+    def add(self, entry):
+        "Record a queued entry"
+        self.__append(b'a\t%d\t%d\t%s\t%s\n%s' % (entry.id, entry.priority,
+                escape(entry.save_in), escape(entry.url), expected_record(entry)))
+
+    def reprioritize(self, entry):
+        "Record a priority change"
+        self.__append(b'p\t%d\t%d\n' % (entry.id, entry.priority))
+
+    def start(self, entry):
+        "Record the partial file of a download"
+        self.__append(partial_record(entry))
+
+    def remove(self, entry):
+        "Record a finished or cancelled entry"
+        self.__append(b'd\t%d\n' % entry.id)
+
+    def commit(self):
+        """Write all buffered records with a single fsync()
+
+        The journal is compacted if it grew too large"""
+        if self.__pending_commit and self.__pending_commit.active():
+            self.__pending_commit.cancel()
+        self.__pending_commit = None
+        if not self.__buffer:
+            return
+
+        records, self.__buffer = self.__buffer, []
+        try:
+            if not self.__file:
+                folder = os.path.dirname(self.path)
+                if folder and not os.path.isdir(folder):
+                    os.makedirs(folder)
+                self.__file = open(self.path, 'ab')
+            self.__file.write(b''.join(records))
+            self.__file.flush()
+            os.fsync(self.__file.fileno())
+        except (IOError, OSError) as ex:
+            logging.warning('Unable to write journal %s: %s' % (self.path, ex))
+            return
+        self.records += len(records)
+        self.compact_if_needed()
+
+    def compact_if_needed(self):
+        """Compact the journal if it holds more than compact_min
+        records and twice as many records as live entries"""
+        if self.records > self.compact_min:
+            live = self.live_entries()
+            if self.records > 2 * len(live):
+                self.compact(live)
+
+    def compact(self, live=None):
+        """Replace the journal with a new file holding only
+        the live entries"""
+        if live is None:
+            live = self.live_entries()
+        # Any buffered records are already reflected in live
+        self.__buffer = []
+
+        tmp = self.path + '.tmp'
+        try:
+            folder = os.path.dirname(self.path)
+            if folder and not os.path.isdir(folder):
+                os.makedirs(folder)
+            with open(tmp, 'wb') as fileobj:
+                fileobj.writelines(b'a\t%d\t%d\t%s\t%s\n%s%s' % (entry.id,
+                        entry.priority, escape(entry.save_in),
+                        escape(entry.url), expected_record(entry),
+                        partial_record(entry))
+                        for entry in sorted(live, key=lambda e: e.id))
+                fileobj.flush()
+                os.fsync(fileobj.fileno())
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as ex:
+            logging.warning('Unable to compact journal %s: %s' % (self.path, ex))
+            return
+
+        if self.__file:
+            self.__file.close()
+            self.__file = None
+        self.records = len(live)
+        logging.info('Compacted journal, %d entries' % self.records)
+
+    def close(self):
+        "Commit buffered records and close the journal"
+        self.commit()
+        if self.__file:
+            self.__file.close()
+            self.__file = None
@@ -0,0 +1,142 @@
+# coding: utf-8
+"""
+dman - daemon metrics
+
+Counters and histograms are updated at the key points of the
+daemon: urldrop ingest, download processes and poke(). An update
+is an integer increment, or a bisect for histograms. Gauges like
+the queue depths are only computed when the metrics are read,
+nothing is formatted until somebody asks.
+
+The metrics are rendered in the Prometheus text format, served
+on the stats socket (see paths.stats_path()) and optionally
+written into metrics_file, see example.cfg. Rates (i.e. urldrop
+frames/s) are derived from the counters by the reader.
+"""
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+from bisect import bisect_left
+from collections import OrderedDict
+
+def format_value(value):
+    """Format a sample value
+
+    >>> print(format_value(3), format_value(0.25), format_value(float('inf')))
+    3 0.25 +Inf
+    """
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return '%d' % value
+
+class Counter(object):
+    """A counter, optionally split by the value of a label
+
+    >>> frames = Counter('frames_total', 'Frames')
+    >>> frames.inc(); frames.inc(2)
+    >>> print('\\n'.join(frames.samples()))
+    frames_total 3
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+
+    def inc(self, amount=1, key=None):
+        "Add amount, key is the label value"
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        "Returns the sample lines"
+        if not self.label:
+            return [ '%s %s' % (self.name, format_value(self.values.get(None, 0))) ]
+        return [ '%s{%s="%s"} %s' % (self.name, self.label, key, format_value(value))
+                for key, value in sorted(self.values.items()) ]
+
+class Gauge(object):
+    "A value read from get() when the metrics are rendered"
+    kind = 'gauge'
+
+    def __init__(self, name, help, get):
+        self.name = name
+        self.help = help
+        self.get = get
+
+    def samples(self):
+        return [ '%s %s' % (self.name, format_value(self.get())) ]
+
+class Histogram(object):
+    """Count observations in buckets, bounds are upper bounds
+
+    >>> latency = Histogram('latency_seconds', 'Latency', (0.1, 1))
+    >>> for value in (0.05, 0.5, 0.7, 3): latency.observe(value)
+    >>> print('\\n'.join(latency.samples()))
+    latency_seconds_bucket{le="0.1"} 1
+    latency_seconds_bucket{le="1"} 3
+    latency_seconds_bucket{le="+Inf"} 4
+    latency_seconds_sum 4.25
+    latency_seconds_count 4
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = sorted(buckets)
+        # the last count is for the +Inf bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        "Add an observation"
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + [float('inf')], self.counts):
+            total += count
+            lines.append('%s_bucket{le="%s"} %d' % (self.name,
+                format_value(bound), total))
+        lines.append('%s_sum %s' % (self.name, format_value(self.sum)))
+        lines.append('%s_count %d' % (self.name, total))
+        return lines
+
+class Registry(object):
+    """The metrics of the daemon, by name
+
+    A metric registered again replaces the old one"""
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+
+    def register(self, metric):
+        "Add a metric, returns it"
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, label=None):
+        return self.register(Counter(name, help, label))
+
+    def gauge(self, name, help, get):
+        return self.register(Gauge(name, help, get))
+
+    def histogram(self, name, help, buckets):
+        return self.register(Histogram(name, help, buckets))
+
+    def render(self):
+        "Returns the metrics in the Prometheus text format, as bytes"
+        lines = []
+        for metric in self.metrics.values():
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            lines.extend(metric.samples())
+        lines.append('')
+        return '\n'.join(lines).encode('utf-8')
+
+METRICS = Registry()
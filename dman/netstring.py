@@ -51,124 +51,141 @@ class InvalidTerminatingCharacter(NetStringError):
 class InvalidLenghtTerminator(NetStringError):
     "Instead of the lenght terminating character we got something else"
     pass
+class FrameTooLong(NetStringError):
+    "The lenght field is larger than the maximum frame length"
+    pass
 
 
 class NetStringReader:
     """
     A class to read netstrings from a socket-like object
+
+    Incoming data is appended to an internal buffer and parsed
+    in bulk, the length prefix is located with find() and each
+    payload is sliced out of the buffer exactly once.
     """
 
-    def __init__(self):
+    def __init__(self, max_length=None, stream_above=None):
         """A Netstring reader
 
-        * sock: is a file like object, i.e. it has a read() method
+        * max_length: netstrings longer than this are rejected with
+          FrameTooLong as soon as the length field is read
+        * stream_above: payloads longer than this are not buffered,
+          they are passed to chunkReceived() as they arrive (feed() only)
         """
-        self.bytes_left = 0
-        self.__buffer = b''
-        self.state = STATE.READ_FIRST_DIGIT
+        self.max_length = max_length
+        self.stream_above = stream_above
+        self.reset()
 
     def reset(self):
         "Reset the reader to its initial state"
         self.bytes_left = 0
-        self.__buffer = b''
+        self.__buffer = bytearray()
+        self.__length = 0
+        self.__result = None
+        self.__streaming = False
         self.state = STATE.READ_FIRST_DIGIT
 
-    def __read_first_digit(self, data):
-        """Handle READ_FIRST_DIGIT state
-        
-        This method reads _only_ the first input byte
-        - If the byte is '0' the next state is READ_COLON
-        - If the byte an ascii digit 1..9 the next state is READ_LENGTH_DIGIT
-        - Any other case is an error
+    def __fail(self, error):
+        "Move into the ERROR state, drop buffered data and raise error"
+        self.state = STATE.ERROR
+        self.__buffer = bytearray()
+        self.__streaming = False
+        raise error
 
-        The return value is 1(the number of consumed bytes) or 0 if data is empty
-        """
-        if not data:
-            return 0
+    def __check_length_field(self, field):
+        """Validate the bytes of a (possibly partial) length field
 
-        if data[0] >= '1' and data[0] <= '9':
-            self.bytes_left = int(data[0]) - ASCII_ZERO
-        elif data[0] == '0':
-            self.bytes_left = 0
-            self.state = STATE.READ_COLON
-            return 1
-        else:
-            self.state = STATE.ERROR
-            raise InvalidLengthField(data[0])
-
-        self.state = STATE.READ_LENGTH_DIGIT
-        return 1
-
-    def __read_length_digit(self, data):
-        """Handle READ_LENGTH_DIGIT state
-        
-        Returns the number of bytes consumed
+        Raises InvalidLengthField for non digits,
+        InvalidLenghtTerminator if a '0' length has more digits
+        and FrameTooLong if the length exceeds max_length
         """
-        if not data:
-            return 0
-
-        if data[0] == ':':
-            self.state = STATE.READ_BYTES
-            self.__buffer = b''
-            return 1
-        if data[0] < '0' or data[0] > '9':
-            self.state = STATE.ERROR
-            raise InvalidLengthField(data[0])
-
-        self.bytes_left = self.bytes_left*10 + (int(data[0]) -ASCII_ZERO )
-        return 1
-
-    def __read_bytes(self, data):
-        """Handle the READ_BYTES state"""
-        if not data:
-            return 0
-
-        read_bytes = data[:self.bytes_left]
-        self.bytes_left -= len(read_bytes)
-        self.__buffer += read_bytes
-
-        if self.bytes_left == 0:
-            self.state = STATE.READ_COMMA
-        return len(read_bytes)
-
-    def __read_comma(self, data):
-        """Handle the READ_COMMA state"""
-        if not data:
-            return 0
-
-        if data[0] != ',':
-            self.state = STATE.ERROR
-            raise InvalidTerminatingCharacter(data[0])
-        self.state = STATE.FINISHED
-        return 1
-
-    def __read_colon(self, data):
-        """Handle the READ_COLON state"""
-        if not data:
-            return 0
-
-        if data[0] != ':':
-            self.state = STATE.ERROR
-            raise InvalidLenghtTerminator(data[0])
-        self.state = STATE.READ_COMMA
-        return 1
-
-    def __feed_cycle(self, data):
-        """Parse the given data and if
-        needed, transition state
-
-        * Returns the amount of bytes consumed from the given buffer
+        if not field.isdigit() or (len(field) > 1 and field[0] == 0x30):
+            for idx, byte in enumerate(field):
+                if byte < 0x30 or byte > 0x39:
+                    self.__fail(InvalidLengthField(chr(byte)))
+                if idx == 1 and field[0] == 0x30:
+                    self.__fail(InvalidLenghtTerminator(chr(byte)))
+
+        if self.max_length is not None and int(field) > self.max_length:
+            self.__fail(FrameTooLong(int(field)))
+
+    def __parse(self, frames, limit=None, stream=False):
+        """Parse as many netstrings as possible from the buffer
+
+        Complete payloads are appended to frames, at most limit
+        frames are parsed. If stream is True large payloads are
+        handed to chunkReceived() instead. Returns the buffer offset
+        where parsing stopped, the caller is responsible for
+        discarding the consumed bytes.
         """
-        if self.state == STATE.READ_FIRST_DIGIT:
-            return self.__read_first_digit(data)
-        elif self.state == STATE.READ_LENGTH_DIGIT:
-            return self.__read_length_digit(data)
-        elif self.state == STATE.READ_BYTES:
-            return self.__read_bytes(data)
-        elif self.state == STATE.READ_COMMA:
-            return self.__read_comma(data)
-        elif self.state == STATE.READ_COLON:
-            return self.__read_colon(data)
+        buf = self.__buffer
+        end = len(buf)
+        pos = 0
+        view = memoryview(buf)
+        try:
+            while pos < end and (limit is None or len(frames) < limit):
+                if self.state not in (STATE.READ_BYTES, STATE.READ_COMMA):
+                    colon = buf.find(b':', pos)
+                    if colon == -1:
+                        self.__check_length_field(buf[pos:])
+                        if buf[pos] == 0x30:
+                            self.state = STATE.READ_COLON
+                        else:
+                            self.state = STATE.READ_LENGTH_DIGIT
+                        break
+                    if colon == pos:
+                        self.__fail(InvalidLengthField(':'))
+                    field = buf[pos:colon]
+                    self.__check_length_field(field)
+                    self.__length = int(field)
+                    self.bytes_left = self.__length
+                    self.state = STATE.READ_BYTES
+                    pos = colon + 1
+
+                    if stream and self.stream_above is not None \
+                            and self.__length > self.stream_above:
+                        # Keep ordering, strings before this frame go first
+                        if frames:
+                            self.stringsReceived(frames[:])
+                            del frames[:]
+                        self.__streaming = True
+                        self.streamStarted(self.__length)
+
+                if self.__streaming:
+                    stop = min(end, pos + self.bytes_left)
+                    if stop > pos:
+                        self.chunkReceived(view[pos:stop].tobytes())
+                        self.bytes_left -= stop - pos
+                        pos = stop
+                    if self.bytes_left or pos == end:
+                        if not self.bytes_left:
+                            self.state = STATE.READ_COMMA
+                        break
+                    if buf[pos] != 0x2c:
+                        self.__fail(InvalidTerminatingCharacter(chr(buf[pos])))
+                    pos += 1
+                    self.__streaming = False
+                    self.state = STATE.READ_FIRST_DIGIT
+                    self.streamFinished()
+                    continue
+
+                stop = pos + self.__length
+                if stop >= end:
+                    # Wait for the payload and its terminating comma
+                    self.bytes_left = max(0, stop - end)
+                    if self.bytes_left == 0:
+                        self.state = STATE.READ_COMMA
+                    break
+                if buf[stop] != 0x2c:
+                    self.__fail(InvalidTerminatingCharacter(chr(buf[stop])))
+                frames.append(view[pos:stop].tobytes())
+                pos = stop + 1
+                self.bytes_left = 0
+                self.state = STATE.READ_FIRST_DIGIT
+        finally:
+            del view
+        return pos
 
     def feedUntilDone(self, data):
         """Feed the given data into the netstring parser
@@ -176,37 +193,84 @@ class NetStringReader:
         The method consumes all bytes UNTIL a netstring can be parsed
         successfully.
         
-        Returns the ammount of bytes consumed"""
+        Returns the ammount of bytes consumed
 
-        if not isinstance(data, str):
-            data = bytes(data)
+        >>> reader = NetStringReader()
+        >>> reader.feedUntilDone(b'5:hel'), reader.feedUntilDone(b'lo,3:abc,')
+        (5, 3)
+        >>> reader.state == STATE.FINISHED
+        True
+        """
 
-        done = 0
-        while done < len(data) and self.state != STATE.FINISHED:
-            done += self.__feed_cycle(data[done:])
+        if self.state == STATE.FINISHED:
+            return 0
 
-        return done
+        if isinstance(data, unicode):
+            data = bytes(data)
+
+        buffered = len(self.__buffer)
+        self.__buffer += data
+        frames = []
+        pos = self.__parse(frames, limit=1)
+        if not frames:
+            # As in feed(), the parsed length field is not read twice
+            del self.__buffer[:pos]
+            return len(data)
+
+        # Bytes past the end of the netstring still belong to the caller
+        self.__result = frames[0]
+        self.__buffer = bytearray()
+        self.state = STATE.FINISHED
+        return pos - buffered
 
     def feed(self, data):
         """Feed data to the parser
+
+        All netstrings completed by data are passed
+        to stringsReceived() as a single batch
         
         see stringReceived()"""
 
-        if not isinstance(data, str):
+        if self.state == STATE.FINISHED:
+            self.reset()
+        if isinstance(data, unicode):
             data = bytes(data)
 
-        done = 0
+        self.__buffer += data
+        frames = []
+        try:
+            pos = self.__parse(frames, stream=True)
+            del self.__buffer[:pos]
+        finally:
+            if frames:
+                self.stringsReceived(frames)
+
+    def stringsReceived(self, strings):
+        """Called with the list of netstrings parsed from a chunk
 
-        while done < len(data):
-            done += self.feedUntilDone(data[done:])
-            if self.state == STATE.FINISHED:
-                self.stringReceived(self.__buffer)
-                self.reset()
+        The default implementation calls stringReceived() for
+        each string, override this to handle strings in bulk
+        """
+        for string in strings:
+            self.stringReceived(string)
 
     def stringReceived(self, string):
         "Override this function to handle new strings"
         print(string)
 
+    def streamStarted(self, length):
+        """Called when a payload larger than stream_above starts,
+        length is the size of the payload in bytes"""
+        pass
+
+    def chunkReceived(self, chunk):
+        "Override this function to handle payload chunks of streamed strings"
+        pass
+
+    def streamFinished(self):
+        "Called after the last chunk of a streamed string"
+        pass
+
     @staticmethod
     def decode(data):
         """Parse a single netstring and return the enclosed string
@@ -222,7 +286,7 @@ class NetStringReader:
         if reader.state != STATE.FINISHED or done != len(data):
             raise NetStringError('Unable to decode netstring')
 
-        result = reader.__buffer
+        result = reader.__result
         return result
 
 
@@ -254,6 +318,21 @@ def encode(string, encoding='utf-8'):
 
     return result
 
+def encode_many(strings, encoding='utf-8'):
+    """Encode an iterable of strings as consecutive netstrings
+
+    The result is a single buffer, suitable for one sendall()
+
+    >>> encode_many([b'a', b'', b'bc'])
+    '1:a,0:,2:bc,'
+    """
+    parts = []
+    for string in strings:
+        if isinstance(string, unicode):
+            string = string.encode(encoding)
+        parts.append(b'%d:%s,' % (len(string), string))
+    return b''.join(parts)
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
@@ -0,0 +1,41 @@
+# coding: utf-8
+"""
+dman - runtime paths
+
+This module is shared by the client and the server, keep it
+free of heavy imports (twisted, plugins) so clients start fast
+"""
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+import os
+
+def runtime_base_path():
+    """Returns the base path to store runtime info
+    if the path does not exist it is created
+
+    If the XDG_RUNTIME_DIR is not available
+    then /tmp/dman-<UID>/ is used"""
+
+    base = os.getenv('XDG_RUNTIME_DIR')
+    if base:
+        folder = os.path.join(base, 'dman')
+    else:
+        folder = "/tmp/dman-%s/" % os.getuid()
+
+    try:
+        os.mkdir(folder)
+    except OSError:
+        pass
+    return folder
+
+def ipc_path():
+    "The path to the ipc socket"
+    return os.path.join(runtime_base_path(), 'ipc')
+
+def urldrop_path():
+    "The path to the urldrop socket"
+    return os.path.join(runtime_base_path(), 'urldrop')
+
+def stats_path():
+    "The path to the stats socket, see dman.metrics"
+    return os.path.join(runtime_base_path(), 'stats')
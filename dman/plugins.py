@@ -9,26 +9,129 @@ delegate download tasks to other applications
 from __future__ import print_function, unicode_literals
 from __future__ import absolute_import, division
 from abc import abstractmethod
-import os, logging
+from collections import deque
+import os, re, json, time, errno, socket, binascii, tempfile, importlib, logging
+from io import BytesIO
 from twisted.internet import reactor, protocol
 from twisted.internet.error import ProcessDone
+from twisted.internet.defer import Deferred
+try:
+    from twisted.web.client import Agent, RedirectAgent, readBody
+    from twisted.web.client import HTTPConnectionPool, ResponseDone, FileBodyProducer
+    from twisted.web.http import PotentialDataLoss
+    from twisted.web.http_headers import Headers
+except ImportError:
+    Agent = None
+from .dedup import normalize_url, url_filename
+from .history import to_text
+from .bandwidth import TokenBucket
+from .metrics import METRICS
+from .paths import runtime_base_path
 
 DEBUG = os.getenv("DMAN_DEBUG", False)
 
+# program -> (PATH, stamp, executable path, executable mtime)
+WHICH_CACHE = {}
+
+# Updated as download processes exit, see dman.metrics
+PROCESS_SECONDS = METRICS.histogram('dman_process_seconds',
+        'Time from spawning a download process to its exit',
+        (1, 5, 15, 60, 300, 900, 3600, 14400))
+PROCESS_EXITS = METRICS.counter('dman_process_exits_total',
+        'Download process exits by exit code', 'code')
+
+def process_exited(spawned, returncode):
+    "Record the exit of a process spawned at time spawned"
+    PROCESS_SECONDS.observe(time.time() - spawned)
+    PROCESS_EXITS.inc(key='signal' if returncode is None else returncode)
+
+def mtime(path):
+    "The modification time of path, or None if it does not exist"
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+SIZE_UNITS = {
+    b'K': 1024, b'KiB': 1024,
+    b'M': 1024 ** 2, b'MiB': 1024 ** 2,
+    b'G': 1024 ** 3, b'GiB': 1024 ** 3,
+    }
+
+def parse_size(number, unit=b''):
+    """Parse sizes printed by wget or aria2c
+
+    >>> parse_size(b'1.5', b'MiB'), parse_size(b'305', b'K'), parse_size(b'12', b'B')
+    (1572864, 312320, 12)
+    """
+    return int(float(number) * SIZE_UNITS.get(unit, 1))
+
+SCHEME_RE = re.compile(r'^([a-zA-Z][a-zA-Z0-9+.-]*):(?!\d)')
+
+def url_scheme(url):
+    """Returns the lowercase scheme of url, None if it has none
+
+    >>> url_scheme('HTTP://a/b'), url_scheme('magnet:?xt=1')
+    (u'http', u'magnet')
+    >>> url_scheme('example.com/file.iso'), url_scheme('example.com:8080/f')
+    (None, None)
+    """
+    match = SCHEME_RE.match(to_text(url))
+    return match.group(1).lower() if match else None
+
 def which(program):
-    "The equivalent to UNIX's which"
+    """The equivalent to UNIX's which
+
+    Results are cached, keyed by PATH and the modification time
+    of the PATH folders and the executable. Installing, removing
+    or replacing the program invalidates the cached result"""
+
+    path_env = os.environ.get("PATH", "")
+    folders = path_env.split(os.pathsep)
+    stamp = tuple(mtime(path) for path in folders)
+    cached = WHICH_CACHE.get(program)
+    if cached and cached[0] == path_env and cached[1] == stamp and \
+            (cached[2] is None or mtime(cached[2]) == cached[3]):
+        return cached[2]
 
-    for path in os.environ["PATH"].split(os.pathsep):
+    found = None
+    for path in folders:
         exe_file = os.path.join(path, program)
 
         if os.path.exists(exe_file) and os.access(exe_file, os.X_OK):
-            return exe_file
+            found = exe_file
+            break
 
-    return None
+    WHICH_CACHE[program] = (path_env, stamp, found, found and mtime(found))
+    return found
 
 
 class Download(object):
-    "The base download class"
+    """The base download class
+
+    Implementations must call dman.download_finished(self)
+    once the download is finished"""
+    # The BatchProcess downloading this url, if any
+    batch = None
+    # The url schemes this plugin can download, None for any
+    schemes = None
+    # The scheme of urls without one (i.e. example.com/file), None
+    # if the plugin can't download them
+    default_scheme = None
+    # Bytes/s this download may use, 0 for no limit
+    rate_limit = 0
+    # False if set_rate_limit() also changes a running download
+    fixed_rate = True
+    # Return codes of transient failures, worth retrying. All
+    # other failures are permanent
+    retriable = frozenset()
+    # Set before start() to the file an earlier attempt left,
+    # plugins continue it (i.e. wget -c -O <partial>)
+    partial = None
+    # Set by DMan when the file does not match the size or sha256
+    # that came with the url, the download then failed
+    verify_error = None
+
     def __init__(self, dman, url, save_in):
         self.dman = dman
         self.url = url
@@ -41,6 +144,10 @@ class Download(object):
     def stop(self):
         "Stop the download"
         pass
+    def interrupt(self):
+        """Stop the download to continue it later, i.e. when dman
+        exits. The partial file must be kept, the default is stop()"""
+        self.stop()
     @abstractmethod
     def started(self):
         """Return True if the download has started
@@ -67,6 +174,38 @@ class Download(object):
         
         You should check succeeded() before calling this"""
         pass
+    def returncode(self):
+        """Returns the exit code of the download application,
+        or None if there is no such thing"""
+        return None
+    def progress(self):
+        """Returns a dict with the downloaded bytes, the total
+        size (or None) and the speed in bytes/s, or None if the
+        progress is unknown"""
+        return None
+    def transient_failure(self):
+        "Returns True if the download failed with a retriable error"
+        return not self.succeeded() and self.returncode() in self.retriable
+    def output_path(self, guess=True):
+        """Returns the path of the downloaded file, the default
+        guesses it from the url like wget does
+
+        Without guess only a path the plugin knows is returned,
+        or None. A guessed name may belong to an unrelated file"""
+        if not guess:
+            return None
+        return os.path.join(self.save_in, url_filename(self.url))
+    def continue_path(self):
+        "Returns the partial file to continue, if it still exists"
+        if self.partial and os.path.exists(self.partial):
+            return self.partial
+        return None
+    def set_rate_limit(self, rate):
+        """Set the bytes/s this download may use, 0 for no limit
+
+        Plugins that can't change the limit of a running download
+        only apply it when they start"""
+        self.rate_limit = rate
     @staticmethod
     @abstractmethod
     def plugin_available():
@@ -74,6 +213,20 @@ class Download(object):
         be used
         """
         return False
+    @classmethod
+    def supports(cls, url, size=None):
+        """Return True if this plugin should download url
+
+        size is the expected file size in bytes, if known"""
+        if cls.schemes is None:
+            return True
+        scheme = url_scheme(url) or cls.default_scheme
+        return scheme is not None and scheme in cls.schemes
+    @classmethod
+    def prefers(cls, url, size=None):
+        """Return True if this plugin should download url even
+        if a plugin listed before it supports url"""
+        return False
 
 
 class ProcessDownload(Download, protocol.ProcessProtocol):
@@ -91,6 +244,14 @@ class ProcessDownload(Download, protocol.ProcessProtocol):
     """
 
     errors = { 0: 'No errors occurred'}
+    # The program name, looked up in PATH
+    executable = None
+    # Only the start and the end of the program output are kept
+    # for parse_progress(), the tail is parsed at most once every
+    # progress_interval seconds and only when progress() is called
+    output_head = 2048
+    output_tail = 512
+    progress_interval = 0.5
 
     def __init__(self, dman, url, save_in):
         super(ProcessDownload, self).__init__( dman, url, save_in)
@@ -98,6 +259,11 @@ class ProcessDownload(Download, protocol.ProcessProtocol):
         self.process = None
         self.__finished = False
         self.__returncode = -1
+        self.__head = b''
+        self.__tail = b''
+        self.__dirty = False
+        self.__parsed = 0
+        self.__progress = None
     @abstractmethod
     def download_cmd(self):
         """Override this to define a download command
@@ -114,6 +280,7 @@ class ProcessDownload(Download, protocol.ProcessProtocol):
         cmd = self.download_cmd()
         logging.debug( 'starting download: ' + ' '.join(cmd) )
         self.process = reactor.spawnProcess( self, cmd[0], cmd)
+        self.__spawned = time.time()
         self.__started = True
         return True
     def stop(self):
@@ -124,9 +291,47 @@ class ProcessDownload(Download, protocol.ProcessProtocol):
     def finished(self):
         return self.__finished
     def succeeded(self):
-        return self.__returncode == 0
+        return self.__returncode == 0 and not self.verify_error
     def error(self):
-        return self.errors.get(self.__returncode, 'Unknown error')
+        return self.verify_error or self.errors.get(self.__returncode,
+                'Unknown error')
+    def returncode(self):
+        return self.__returncode
+    def output_path(self, guess=True):
+        return self.parse_path(self.__head, self.__tail) or \
+                super(ProcessDownload, self).output_path(guess)
+    def outReceived(self, data):
+        self.__output(data)
+    def errReceived(self, data):
+        self.__output(data)
+    def __output(self, data):
+        "Keep the head and tail of the output, nothing is parsed here"
+        if len(self.__head) < self.output_head:
+            self.__head += data[:self.output_head - len(self.__head)]
+        if len(data) >= self.output_tail:
+            self.__tail = data[-self.output_tail:]
+        else:
+            self.__tail = (self.__tail + data)[-self.output_tail:]
+        self.__dirty = True
+    def progress(self):
+        if self.__dirty:
+            now = time.time()
+            if now - self.__parsed >= self.progress_interval:
+                self.__dirty = False
+                self.__parsed = now
+                self.__progress = self.parse_progress(self.__head,
+                        self.__tail) or self.__progress
+        return self.__progress
+    def parse_progress(self, head, tail):
+        """Override this to parse the program output
+
+        head and tail are the first and last bytes of the output,
+        returns a dict like progress() or None"""
+        return None
+    def parse_path(self, head, tail):
+        """Override this to parse the downloaded file path from
+        the program output, returns None if it is not there"""
+        return None
     def processEnded(self, status):
         """Twisted ProcessProtocol exit handler"""
 
@@ -135,8 +340,9 @@ class ProcessDownload(Download, protocol.ProcessProtocol):
         else:
             self.__returncode = status.value.exitCode
         self.__finished = True
+        process_exited(self.__spawned, self.__returncode)
         logging.debug('Download finished '+ self.url + ' in '+ self.save_in + str(self.__returncode))
-        self.dman.poke()
+        self.dman.download_finished(self)
 
 class WGetDownload(ProcessDownload):
     """A download using the popular WGet"""
@@ -152,19 +358,48 @@ class WGetDownload(ProcessDownload):
         7: 'Protocol error',
         8: 'Server issued and error'
         }
+    retriable = frozenset([4])
 
-    wget = which('wget')
+    executable = 'wget'
+    schemes = ('http', 'https', 'ftp')
+    default_scheme = 'http'
 
-    @staticmethod
-    def plugin_available():
-        if WGetDownload.wget:
-            return True
-        else:
-            return False
+    # Length: 1048576 (1.0M) [application/octet-stream]
+    length_re = re.compile(br'Length: (\d+)')
+    #     50K .......... .......... .......... .......... .......... 51%  305K 3s
+    dots_re = re.compile(br'(\d+)K ([. ]+?) *(\d+)% +([\d.]+)([KMG]?)')
+    # Saving to: ‘/path/file’
+    saving_re = re.compile(br'Saving to: (?:\xe2\x80\x98|[\'`"])(.+?)'
+            br'(?:\xe2\x80\x99|[\'"])\r?\n')
+
+    @classmethod
+    def plugin_available(cls):
+        return which(cls.executable) is not None
     def download_cmd(self):
         "Downloads are just: wget URL"
-        cmd = [self.wget, '-P', self.save_in, self.url]
+        partial = self.continue_path()
+        if partial:
+            cmd = [which(self.executable), '--progress=dot', '-c', '-O', partial,
+                    self.url]
+        else:
+            cmd = [which(self.executable), '--progress=dot', '-P', self.save_in,
+                    self.url]
+        if self.rate_limit:
+            cmd.insert(1, '--limit-rate=%d' % self.rate_limit)
         return cmd
+    def parse_progress(self, head, tail):
+        "Parse the last complete line of dots, each dot is 1KiB"
+        matches = self.dots_re.findall(tail)
+        if not matches:
+            return None
+        offset, dots, percent, speed, unit = matches[-1]
+        length = self.length_re.search(head)
+        return {'bytes': (int(offset) + dots.count(b'.')) * 1024,
+                'total': int(length.group(1)) if length else None,
+                'speed': parse_size(speed, unit)}
+    def parse_path(self, head, tail):
+        match = self.saving_re.search(head)
+        return match.group(1) if match else None
 
 class AriaDownload(ProcessDownload):
     """Download using aria2c"""
@@ -175,29 +410,1144 @@ class AriaDownload(ProcessDownload):
         6: 'Network error',
         9: 'Not enough disk space',
         17: 'I/O error',
+        19: 'Name resolution failed',
         }
+    retriable = frozenset([2, 6, 19])
+
+    executable = 'aria2c'
+    schemes = ('http', 'https', 'ftp', 'sftp')
+
+    # [#2089b0 400KiB/1.0MiB(39%) CN:1 DL:115KiB ETA:5s]
+    readout_re = re.compile(br'\[#\w+ ([\d.]+)(\w+)/([\d.]+)(\w+).*? DL:([\d.]+)(\w+)')
+    # 2089b0|OK  |   1.2MiB/s|/path/file
+    result_re = re.compile(br'^[0-9a-f]+\|OK\s*\|[^|]*\|(.+?)\r?$', re.M)
+
+    @classmethod
+    def plugin_available(cls):
+        return which(cls.executable) is not None
+
+    def download_cmd(self):
+        "aria2c -d <save_in> <url>"
+        partial = self.continue_path()
+        if partial:
+            folder, name = os.path.split(partial)
+            cmd = [which(self.executable), '-c', '-d', folder, '-o', name, self.url]
+        else:
+            cmd = [which(self.executable), '-d', self.save_in, self.url]
+        if self.rate_limit:
+            cmd.insert(1, '--max-download-limit=%d' % self.rate_limit)
+        return cmd
+    def parse_progress(self, head, tail):
+        "Parse the last console readout"
+        matches = self.readout_re.findall(tail)
+        if not matches:
+            return None
+        done, done_unit, total, total_unit, speed, speed_unit = matches[-1]
+        return {'bytes': parse_size(done, done_unit),
+                'total': parse_size(total, total_unit) or None,
+                'speed': parse_size(speed, speed_unit)}
+    def parse_path(self, head, tail):
+        "Parse the download results table"
+        match = self.result_re.search(tail)
+        return match.group(1) if match else None
+
+class BatchedDownload(Download):
+    """A single url downloaded by a BatchProcess
+
+    The batch parses the application output and calls
+    done() as each url finishes"""
+
+    def __init__(self, dman, url, save_in, batch):
+        super(BatchedDownload, self).__init__(dman, url, save_in)
+        self.batch = batch
+        self.__finished = False
+        self.__returncode = -1
+        self.__path = None
+    def start(self):
+        return self.batch.start()
+    def stop(self):
+        self.batch.stop_download(self)
+    def started(self):
+        return self.batch.started()
+    def finished(self):
+        return self.__finished
+    def succeeded(self):
+        return self.__returncode == 0 and not self.verify_error
+    def error(self):
+        return self.verify_error or self.batch.plugin.errors.get(
+                self.__returncode, 'Unknown error')
+    def transient_failure(self):
+        return not self.succeeded() and \
+                self.__returncode in self.batch.plugin.retriable
+    def returncode(self):
+        return self.__returncode
+    def output_path(self, guess=True):
+        return self.__path or super(BatchedDownload, self).output_path(guess)
+    def done(self, returncode, path=None):
+        """Called by the batch when this url is finished, with the
+        file path if the output has it"""
+        if self.__finished:
+            return
+        self.__returncode = returncode
+        self.__path = path
+        self.__finished = True
+        self.dman.download_finished(self)
+
+class BatchProcess(protocol.ProcessProtocol):
+    """
+    Download a group of urls into the same folder with a
+    single process, the urls are written into its stdin.
+
+    Subclasses MUST:
+    * Set plugin to the ProcessDownload class they batch
+    * Override batch_cmd() and line_received()
+
+    Urls the output parser did not resolve when the process
+    exits take unresolved_code(). Once the process exits
+    dman.batch_finished() is called.
+    """
+    plugin = None
+    # Bytes/s for the whole process, 0 for no limit
+    rate_limit = 0
+    fixed_rate = True
+
+    def __init__(self, dman, urls, save_in):
+        self.dman = dman
+        self.save_in = save_in
+        self.downloads = [ BatchedDownload(dman, url, save_in, self)
+                for url in urls ]
+        self.process = None
+        self.__started = False
+        self.__stopped = set()
+        self.__buffers = {}
+    @abstractmethod
+    def batch_cmd(self):
+        "Override this to define the command, it reads urls from stdin"
+        pass
+    def batch_input(self):
+        "The data written into the process stdin, one url per line"
+        return b''.join( to_bytes(d.url) + b'\n' for d in self.downloads )
+    @abstractmethod
+    def line_received(self, line):
+        "Override this to parse output lines and resolve downloads"
+        pass
+    def set_rate_limit(self, rate):
+        "See Download.set_rate_limit(), applied when the process starts"
+        self.rate_limit = rate
+    def unresolved_code(self, returncode):
+        "The return code of urls the output did not resolve"
+        return returncode
+    def start(self):
+        if self.__started:
+            return False
+
+        cmd = self.batch_cmd()
+        logging.debug( 'starting batch of %d downloads: %s'
+                % (len(self.downloads), ' '.join(cmd)) )
+        self.process = reactor.spawnProcess( self, cmd[0], cmd)
+        self.__spawned = time.time()
+        self.__started = True
+        return True
+    def started(self):
+        return self.__started
+    def stop_download(self, download):
+        """Stop a download in this batch
+
+        The process is only interrupted once all unfinished
+        downloads were stopped, until then it keeps running"""
+        self.__stopped.add(download)
+        unfinished = [ d for d in self.downloads if not d.finished() ]
+        if self.__started and all(d in self.__stopped for d in unfinished):
+            self.process.signalProcess('INT')
+    def connectionMade(self):
+        self.transport.write(self.batch_input())
+        self.transport.closeStdin()
+    def childDataReceived(self, childFD, data):
+        "Split stdout and stderr into lines for line_received()"
+        lines = (self.__buffers.get(childFD, b'') + data).split(b'\n')
+        self.__buffers[childFD] = lines.pop()
+        for line in lines:
+            self.line_received(line.rstrip(b'\r'))
+    def processEnded(self, status):
+        """Twisted ProcessProtocol exit handler"""
+        for childFD in list(self.__buffers):
+            line = self.__buffers.pop(childFD)
+            if line:
+                self.line_received(line)
+
+        if isinstance(status.value, ProcessDone):
+            returncode = 0
+        else:
+            returncode = status.value.exitCode
+        process_exited(self.__spawned, returncode)
+        logging.debug('Batch finished in %s with %s' % (self.save_in, returncode))
+        for download in self.downloads:
+            download.done(self.unresolved_code(returncode))
+        self.dman.batch_finished(self)
+
+def to_bytes(string):
+    "Encode unicode strings for the process command or input"
+    if isinstance(string, unicode):
+        return string.encode('utf-8')
+    return string
+
+class WGetBatch(BatchProcess):
+    """wget -nv -i -
+
+    wget downloads the urls one by one, with -nv it prints
 
-    aria2c = which('aria2c')
+        <date> <time> URL:<url> [<size>] -> "<file>" [1]
 
+    for each saved url, or
+
+        <url>:
+        <date> <time> ERROR 404: Not Found.
+
+    for server errors. After a redirect the URL is the final one,
+    the file is still named after the url given to wget.
+
+    >>> batch = WGetBatch(None, ['http://a/1', 'http://a/redir'], '/tmp')
+    >>> batch.batch_input()
+    'http://a/1\\nhttp://a/redir\\n'
+    >>> batch.saved_as(b'/tmp/redir.1') is batch.downloads[1]
+    True
+    """
+    plugin = WGetDownload
+
+    def __init__(self, dman, urls, save_in):
+        # ProcessProtocol is an old-style class, no super()
+        BatchProcess.__init__(self, dman, urls, save_in)
+        # wget may print urls in a different form
+        self.by_url = {}
+        for download in self.downloads:
+            self.by_url.setdefault(normalize_url(download.url), deque()).append(download)
+        self.failed_url = None
+    def batch_cmd(self):
+        cmd = [which(self.plugin.executable), '-nv', '-P', self.save_in,
+                '-i', '-']
+        if self.rate_limit:
+            cmd.insert(1, '--limit-rate=%d' % self.rate_limit)
+        return cmd
+    def resolve(self, url, returncode, path=None):
+        """Resolve the first unfinished download for url, or the
+        one saved as path"""
+        queue = self.by_url.get(normalize_url(url))
+        while queue and queue[0].finished():
+            queue.popleft()
+        download = queue.popleft() if queue else self.saved_as(path)
+        if download:
+            download.done(returncode, path)
+    def saved_as(self, path):
+        """The first unfinished download whose file name is the
+        name of path, maybe with a .<n> suffix"""
+        if not path:
+            return None
+        name = to_text(os.path.basename(path))
+        for download in self.downloads:
+            if download.finished():
+                continue
+            guess = url_filename(download.url)
+            if name == guess or (name.startswith(guess + '.') and
+                    name[len(guess) + 1:].isdigit()):
+                return download
+        return None
+    def unresolved_code(self, returncode):
+        """A url the output did not resolve failed for an unknown
+        reason, not the one in the exit code. It is retried on its
+        own as a network failure"""
+        return 0 if returncode == 0 else 4
+    def line_received(self, line):
+        if b' URL:' in line:
+            path = line.partition(b' -> "')[2].rpartition(b'"')[0]
+            self.resolve(line.split(b' URL:', 1)[1].split(b' ', 1)[0], 0,
+                    path or None)
+        elif line.endswith(b':') and b'://' in line and b' ' not in line:
+            self.failed_url = line[:-1]
+        elif self.failed_url and b' ERROR ' in line:
+            # Server issued an error response
+            self.resolve(self.failed_url, 8)
+            self.failed_url = None
+
+class AriaBatch(BatchProcess):
+    """aria2c --input-file=-
+
+    Each url gets a gid, starting with its index in the batch,
+    aria2c prints the result for each gid at exit:
+
+        gid   |stat|avg speed  |path/URI
+        000001|OK  |   1.2MiB/s|/path/file
+    """
+    plugin = AriaDownload
+    result_re = re.compile(br'^([0-9a-f]{6})\|(\w+)\s*\|[^|]*\|(.*?)\r?$')
+
+    def batch_cmd(self):
+        cmd = [which(self.plugin.executable), '-d', self.save_in, '--input-file=-',
+                '--summary-interval=0']
+        if self.rate_limit:
+            cmd.insert(1, '--max-overall-download-limit=%d' % self.rate_limit)
+        return cmd
+    def batch_input(self):
+        return b''.join( b'%s\n gid=%06x0000000000\n' % (to_bytes(d.url), idx + 1)
+                for idx, d in enumerate(self.downloads) )
+    def line_received(self, line):
+        match = self.result_re.match(line)
+        if not match:
+            return
+        idx = int(match.group(1), 16) - 1
+        if 0 <= idx < len(self.downloads):
+            if match.group(2) == b'OK':
+                self.downloads[idx].done(0, match.group(3) or None)
+            else:
+                self.downloads[idx].done(1)
+
+def free_port():
+    "Returns a free local tcp port"
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+class AriaRpcSession(protocol.ProcessProtocol):
+    """A long lived aria2c process controlled over JSON-RPC
+
+    aria2c keeps its own connection reuse and segmenting across
+    all downloads. New downloads are added and running ones are
+    polled every interval seconds, all calls are sent in a single
+    system.multicall request.
+
+    The rpc secret is written into a private aria2c config file,
+    command lines are visible to every local user.
+    """
+    # The session shared by all AriaRpcDownload objects
+    current = None
+    status_keys = ['status', 'errorCode', 'errorMessage', 'completedLength',
+            'totalLength', 'downloadSpeed', 'files']
+
+    @classmethod
+    def get(cls, dman):
+        "Returns the running session, aria2c is started if needed"
+        if not cls.current or cls.current.exited:
+            cls.current = cls(
+                    dman.config_get('aria2_rpc_port', 0, dman.config.getint),
+                    dman.config_get('aria2_rpc_interval', 0.5, dman.config.getfloat))
+            cls.current.start()
+        return cls.current
+
+    def __init__(self, port=0, interval=0.5):
+        self.port = port or free_port()
+        self.interval = interval
+        self.url = b'http://127.0.0.1:%d/jsonrpc' % self.port
+        self.secret = binascii.hexlify(os.urandom(16)).decode('ascii')
+        # downloads waiting for a gid
+        self.adding = []
+        # gids to remove
+        self.removing = []
+        # gid -> download
+        self.active = {}
+        # downloads stopped while their addUri call was running
+        self.stopping = set()
+        # (gid, options) for aria2.changeOption
+        self.changing = []
+        self.exited = False
+        self.conf_path = None
+        # a single kept alive connection for the rpc calls
+        self.pool = None
+        self.agent = None
+        self.__timer = None
+        self.__busy = False
+    def start(self):
+        "Start aria2c, it exits with the dman process"
+        fd, self.conf_path = tempfile.mkstemp(prefix='aria2-', suffix='.conf',
+                dir=runtime_base_path())
+        with os.fdopen(fd, 'wb') as fileobj:
+            fileobj.write(('rpc-secret=%s\n' % self.secret).encode('ascii'))
+        cmd = [which(AriaDownload.executable), '--conf-path=%s' % self.conf_path,
+                '--enable-rpc', '--rpc-listen-all=false',
+                '--rpc-listen-port=%d' % self.port,
+                '--stop-with-process=%d' % os.getpid(), '--quiet']
+        logging.debug('starting aria2c rpc on port %d' % self.port)
+        reactor.spawnProcess(self, cmd[0], cmd)
+    def remove_conf(self):
+        "Remove the config file, once aria2c has read it"
+        if self.conf_path:
+            try:
+                os.unlink(self.conf_path)
+            except OSError:
+                pass
+            self.conf_path = None
+    def processEnded(self, status):
+        """Twisted ProcessProtocol exit handler, downloads
+        in this session fail"""
+        self.exited = True
+        self.remove_conf()
+        if self.pool:
+            self.pool.closeCachedConnections()
+        logging.warning('aria2c rpc exited: %s' % status.value)
+        downloads = self.adding + list(self.active.values())
+        self.adding = []
+        self.active.clear()
+        for download in downloads:
+            download.update({'status': 'error', 'errorCode': '1',
+                'errorMessage': 'aria2c exited'})
+    def schedule(self):
+        "Schedule a flush() unless one is scheduled or running"
+        if not self.__timer and not self.__busy and not self.exited:
+            self.__timer = reactor.callLater(self.interval, self.flush)
+    def add(self, download):
+        "Add a download, it gets a gid in the next flush()"
+        self.adding.append(download)
+        self.schedule()
+    def remove(self, download):
+        "Remove a download from aria2c"
+        if download in self.adding:
+            self.adding.remove(download)
+            download.update({'status': 'removed'})
+        elif download.gid in self.active:
+            self.removing.append(download.gid)
+            self.schedule()
+        else:
+            self.stopping.add(download)
+    def change_option(self, download, options):
+        "Change the options of a running download"
+        self.changing.append((download.gid, options))
+        self.schedule()
+    def post(self, body):
+        """Send a JSON-RPC request, returns a Deferred that fires
+        with the response body. The connection is kept alive for
+        the next poll"""
+        if self.agent is None:
+            self.pool = HTTPConnectionPool(reactor, persistent=True)
+            self.pool.maxPersistentPerHost = 1
+            self.agent = Agent(reactor, pool=self.pool)
+        deferred = self.agent.request(b'POST', self.url,
+                Headers({b'Content-Type': [b'application/json']}),
+                FileBodyProducer(BytesIO(body)))
+        return deferred.addCallback(self.__read)
+    def __read(self, response):
+        "The body is always read, the connection goes back to the pool"
+        def check(data):
+            if response.code != 200:
+                raise IOError('HTTP %d from aria2c' % response.code)
+            return data
+        return readBody(response).addCallback(check)
+    def flush(self):
+        "Send the queued calls and poll the active downloads"
+        self.__timer = None
+        adding, self.adding = self.adding, []
+        removing, self.removing = self.removing, []
+        changing, self.changing = self.changing, []
+        polled = list(self.active.values())
+        calls = [ ('aria2.addUri', [[d.url], d.options()]) for d in adding ]
+        calls += [ ('aria2.remove', [gid]) for gid in removing ]
+        calls += [ ('aria2.changeOption', [gid, options])
+                for gid, options in changing ]
+        calls += [ ('aria2.tellStatus', [d.gid, self.status_keys]) for d in polled ]
+        if not calls:
+            return
+
+        token = 'token:' + self.secret
+        body = json.dumps({'jsonrpc': '2.0', 'id': 'dman',
+            'method': 'system.multicall',
+            'params': [[ {'methodName': method, 'params': [token] + params}
+                for method, params in calls ]]})
+        self.__busy = True
+        deferred = self.post(body.encode('utf-8'))
+        deferred.addCallbacks(self.__results, self.__failed,
+                callbackArgs=(adding, removing, changing, polled),
+                errbackArgs=(adding, removing, changing))
+    def __results(self, data, adding, removing, changing, polled):
+        "Dispatch the system.multicall results"
+        self.__busy = False
+        # aria2c answered, it has read its config
+        self.remove_conf()
+        try:
+            results = json.loads(data)['result']
+        except (ValueError, KeyError, TypeError):
+            logging.warning('Invalid aria2c rpc response: %r' % data[:200])
+            results = []
+        results = iter(results)
+
+        for download in adding:
+            result = next(results, None)
+            if isinstance(result, list):
+                download.gid = result[0]
+                self.active[download.gid] = download
+                download.update({'status': 'waiting'})
+                if download in self.stopping:
+                    self.stopping.discard(download)
+                    self.removing.append(download.gid)
+            else:
+                self.stopping.discard(download)
+                download.update({'status': 'error', 'errorCode': '1',
+                    'errorMessage': (result or {}).get('message', 'Unknown error')})
+        for call in removing + changing:
+            next(results, None)
+        for download in polled:
+            result = next(results, None)
+            if isinstance(result, list) and download.gid in self.active:
+                if result[0].get('status') in ('complete', 'error', 'removed'):
+                    del self.active[download.gid]
+                download.update(result[0])
+
+        if self.adding or self.removing or self.active:
+            self.schedule()
+    def __failed(self, failure, adding, removing, changing):
+        "aria2c may still be starting, retry the calls later"
+        self.__busy = False
+        logging.debug('aria2c rpc request failed: %s' % failure.getErrorMessage())
+        self.adding[:0] = adding
+        self.removing[:0] = removing
+        self.changing[:0] = changing
+        self.schedule()
+
+class AriaRpcDownload(Download):
+    """Download using a shared aria2c process, see AriaRpcSession"""
+    errors = AriaDownload.errors
+    retriable = AriaDownload.retriable
+    schemes = AriaDownload.schemes
+    fixed_rate = False
+    # Opt-in, DMan sets this from aria2_rpc in the config
+    enabled = False
+
+    def __init__(self, dman, url, save_in):
+        super(AriaRpcDownload, self).__init__(dman, url, save_in)
+        self.gid = None
+        self.session = None
+        self.__status = None
+        self.__returncode = -1
+        self.__error = None
+        self.__progress = None
+        self.__path = None
+    @classmethod
+    def plugin_available(cls):
+        return cls.enabled and Agent is not None and AriaDownload.plugin_available()
+    def start(self):
+        if self.session:
+            return False
+        self.session = AriaRpcSession.get(self.dman)
+        self.session.add(self)
+        return True
+    def stop(self):
+        if self.session and not self.finished():
+            self.session.remove(self)
+    def started(self):
+        return self.session is not None
+    def finished(self):
+        return self.__status in ('complete', 'error', 'removed')
+    def succeeded(self):
+        return self.__status == 'complete' and not self.verify_error
+    def error(self):
+        if self.verify_error or self.__error:
+            return self.verify_error or self.__error
+        return self.errors.get(self.__returncode, 'Unknown error')
+    def returncode(self):
+        return self.__returncode
+    def progress(self):
+        return self.__progress
+    def output_path(self, guess=True):
+        return self.__path or super(AriaRpcDownload, self).output_path(guess)
+    def options(self):
+        "The aria2.addUri options"
+        options = {'dir': self.save_in}
+        if self.rate_limit:
+            options['max-download-limit'] = '%d' % self.rate_limit
+        partial = self.continue_path()
+        if partial:
+            folder, name = os.path.split(to_text(partial))
+            options.update({'dir': folder, 'out': name, 'continue': 'true'})
+        return options
+    def set_rate_limit(self, rate):
+        "Running downloads are changed with aria2.changeOption"
+        if rate == self.rate_limit:
+            return
+        self.rate_limit = rate
+        if self.gid and not self.finished():
+            self.session.change_option(self, {'max-download-limit': '%d' % rate})
+    def update(self, status):
+        """Called by the session with an aria2.tellStatus result,
+        dman is notified once the download is finished"""
+        if self.finished():
+            return
+        self.__status = status.get('status')
+        files = status.get('files')
+        if files and files[0].get('path'):
+            self.__path = files[0]['path']
+        if 'completedLength' in status:
+            self.__progress = {'bytes': int(status['completedLength']),
+                    'total': int(status.get('totalLength', 0)) or None,
+                    'speed': int(status.get('downloadSpeed', 0))}
+        if not self.finished():
+            return
+        if self.__status == 'complete':
+            self.__returncode = 0
+        else:
+            try:
+                self.__returncode = int(status.get('errorCode', 1))
+            except ValueError:
+                self.__returncode = 1
+            self.__error = status.get('errorMessage') or None
+            if self.__status == 'removed':
+                self.__error = 'Cancelled'
+        logging.debug('Download finished %s in %s %s' % (self.url,
+            self.save_in, self.__status))
+        self.dman.download_finished(self)
+
+class BodyWriter(protocol.Protocol):
+    """Stream a response body into a file
+
+    Data is gathered in a fixed size buffer that is written
+    out each time it fills up. The finished Deferred fires with
+    the number of bytes received. Without a file the body is
+    read and dropped, so the connection can be reused.
+
+    If limit is set only that many bytes are accepted, then the
+    connection is closed. If a TokenBucket is given reading pauses
+    while it is empty"""
+
+    def __init__(self, fileobj, buf, finished, limit=None, bucket=None):
+        self.fileobj = fileobj
+        self.buf = buf
+        self.view = memoryview(buf)
+        self.used = 0
+        self.received = 0
+        # bytes handed to the file
+        self.written = 0
+        self.limit = limit
+        self.finished = finished
+        self.failure = None
+        self.bucket = bucket
+        self.paused = False
+        self.done = False
+    def dataReceived(self, data):
+        if self.limit is not None:
+            if self.received >= self.limit:
+                return
+            data = data[:self.limit - self.received]
+        self.received += len(data)
+        if self.fileobj:
+            try:
+                self.write(data)
+            except IOError as ex:
+                self.failure = ex
+                self.fileobj = None
+                self.transport.stopProducing()
+                return
+        if self.limit is not None and self.received >= self.limit:
+            self.transport.stopProducing()
+        elif self.bucket:
+            delay = self.bucket.consume(len(data))
+            if delay and not self.paused:
+                self.paused = True
+                self.transport.pauseProducing()
+                reactor.callLater(delay, self.resume)
+    def resume(self):
+        "Resume reading after a rate limit pause"
+        self.paused = False
+        if not self.done:
+            self.transport.resumeProducing()
+    def write(self, data):
+        "Buffer data, the buffer is written out once it is full"
+        if self.used + len(data) > len(self.buf):
+            self.flush()
+            if len(data) >= len(self.buf):
+                self.fileobj.write(data)
+                self.written += len(data)
+                return
+        self.view[self.used:self.used + len(data)] = data
+        self.used += len(data)
+    def flush(self):
+        "Write the buffered data"
+        if self.used:
+            self.fileobj.write(self.view[:self.used])
+            self.written += self.used
+            self.used = 0
+    def connectionLost(self, reason):
+        self.done = True
+        if self.fileobj and not self.failure:
+            try:
+                self.flush()
+            except IOError as ex:
+                self.failure = ex
+        if self.failure:
+            self.finished.errback(self.failure)
+        elif self.limit is not None and self.received >= self.limit:
+            self.finished.callback(self.received)
+        elif reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(self.received)
+        else:
+            self.finished.errback(reason)
+
+class RangesUnsupported(Exception):
+    "The server ignored a Range request"
+
+class HttpDownload(Download):
+    """Download http(s) urls inside the dman process
+
+    Responses are streamed to disk by the reactor, no process is
+    spawned. Connections are kept alive in a pool shared by all
+    downloads, with up to http_pool_size idle connections per host.
+    The body goes into <file>.part, renamed once it is complete.
+
+    Files of at least http_segment_min_size bytes, from servers that
+    accept byte ranges, are split into http_segments ranges fetched
+    in parallel. Each segment writes at its own offset of the
+    preallocated .part file and the progress is saved in a
+    <file>.part.segments sidecar, so an interrupted download resumes
+    without fetching the finished ranges again. Smaller files from
+    such servers are a single segment, they resume the same way.
+    """
+    errors = {
+        0: 'No problems occured',
+        1: 'Unknown error',
+        2: 'Unsupported url',
+        3: 'I/O error',
+        4: 'Network failure',
+        8: 'Server issued an error',
+        }
+    retriable = frozenset([4])
+    schemes = ('http', 'https')
+    default_scheme = 'http'
+    fixed_rate = False
+    # Shared by all downloads
+    agent = None
+    pool = None
+    # Write buffers, reused by the next downloads
+    buffer_size = 64 * 1024
+    free_buffers = []
+    # Seconds between sidecar updates
+    checkpoint_interval = 1
+    # Files expected to be at least this large are downloaded here
+    # even if aria2c or wget are available, 0 never. DMan sets it
+    # from http_prefer_min_size
+    prefer_min_size = 0
+    # Paths of the running downloads, two urls with the same file
+    # name must not write into the same .part file
+    in_use = set()
+
+    def __init__(self, dman, url, save_in):
+        super(HttpDownload, self).__init__(dman, url, save_in)
+        # Like wget, urls without a scheme are http
+        self.request_url = to_bytes(url) if url_scheme(url) \
+                else b'http://' + to_bytes(url)
+        self.path = None
+        # [start, position, end, request or BodyWriter] for
+        # segmented downloads
+        self.segments = None
+        self.__deferred = None
+        # the BodyWriter of a single stream download
+        self.__body = None
+        self.__all = None
+        self.__running = 0
+        # cleared if the server ignores Range requests
+        self.__segmenting = True
+        # shared by all segments
+        self.bucket = TokenBucket()
+        self.__timer = None
+        self.__stopped = False
+        # stopped by interrupt(), the segments are kept
+        self.__interrupted = False
+        self.__finished = False
+        self.__returncode = -1
+        self.__error = None
     @staticmethod
     def plugin_available():
-        if AriaDownload.aria2c:
+        return Agent is not None
+    @classmethod
+    def prefers(cls, url, size=None):
+        "Large files are fetched in parallel byte ranges"
+        return bool(cls.prefer_min_size) and size is not None and \
+                size >= cls.prefer_min_size and cls.supports(url, size)
+    @classmethod
+    def get_agent(cls, dman):
+        "Returns the Agent shared by all downloads"
+        if cls.agent is None:
+            cls.pool = HTTPConnectionPool(reactor, persistent=True)
+            cls.pool.maxPersistentPerHost = dman.config_get('http_pool_size',
+                    2, dman.config.getint)
+            cls.agent = RedirectAgent(Agent(reactor, pool=cls.pool))
+        return cls.agent
+    def start(self):
+        if self.__deferred or self.__finished:
+            return False
+
+        if not self.request_url.lower().startswith((b'http://', b'https://')):
+            # Not from inside poke()
+            reactor.callLater(0, self.__done, 2)
             return True
+        logging.debug('starting http download: %s' % self.url)
+        self.path = self.target_path()
+        self.segments = self.load_segments()
+        if self.segments:
+            logging.info('Resuming %s' % self.path)
+            self.__deferred = self.__run_segments()
         else:
-            return False
+            self.__deferred = self.__request()
+            self.__deferred.addCallback(self.__response)
+        self.__deferred.addCallbacks(self.__success, self.__failure)
+        return True
+    def stop(self):
+        if self.__finished:
+            return
+        self.__stopped = True
+        if self.segments:
+            self.__stop_segments()
+        elif self.__body:
+            self.__body.transport.stopProducing()
+        elif self.__deferred:
+            self.__deferred.cancel()
+    def interrupt(self):
+        "A segmented .part file and its sidecar are kept for resuming"
+        self.__interrupted = True
+        self.stop()
+    def started(self):
+        return self.__deferred is not None or self.__finished
+    def finished(self):
+        return self.__finished
+    def succeeded(self):
+        return self.__returncode == 0 and not self.verify_error
+    def error(self):
+        return self.verify_error or self.__error or \
+                self.errors.get(self.__returncode, 'Unknown error')
+    def returncode(self):
+        return self.__returncode
+    def output_path(self, guess=True):
+        return self.path or super(HttpDownload, self).output_path(guess)
+    def set_rate_limit(self, rate):
+        "Takes effect immediately, reading pauses when over the limit"
+        self.rate_limit = rate
+        self.bucket.rate = rate
+    def target_path(self):
+        """The file name for the url, with a numeric suffix like wget
 
-    def download_cmd(self):
-        "aria2c -d <save_in> <url>"
-        cmd = [self.aria2c, '-d', self.save_in, self.url]
-        return cmd
+        A name with a sidecar for the same url is reused, a new name
+        is reserved by creating its empty .part file"""
+        path = os.path.join(self.save_in, url_filename(self.url))
+        candidate, idx = path, 0
+        while candidate in self.in_use or (
+                self.load_segments(candidate) is None and
+                (os.path.exists(candidate) or not self.reserve(candidate))):
+            idx += 1
+            candidate = '%s.%d' % (path, idx)
+        self.in_use.add(candidate)
+        return candidate
+    @staticmethod
+    def reserve(path):
+        "Create an empty path.part, False if it already exists"
+        try:
+            os.close(os.open(path + '.part', os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+        except OSError as ex:
+            # Other errors show up when the body is written
+            return ex.errno != errno.EEXIST
+        return True
+    def load_segments(self, path=None):
+        "Returns the segments in the sidecar for path, if it is for this url"
+        sidecar = (path or self.path) + '.part.segments'
+        try:
+            with open(sidecar, 'rb') as fileobj:
+                state = json.loads(fileobj.read().decode('utf-8'))
+            if state['url'] != to_text(self.url):
+                return None
+            return [ [start, pos, end, None] for start, pos, end in state['segments'] ]
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+    def save_segments(self):
+        "Write the segments progress into the sidecar"
+        sidecar = self.path + '.part.segments'
+        segments = [ [start, pos + (writer.written
+            if isinstance(writer, BodyWriter) else 0), end]
+            for start, pos, end, writer in self.segments ]
+        try:
+            with open(sidecar + '.tmp', 'wb') as fileobj:
+                fileobj.write(json.dumps({'url': to_text(self.url),
+                    'segments': segments}).encode('utf-8'))
+            os.rename(sidecar + '.tmp', sidecar)
+        except (IOError, OSError) as ex:
+            logging.warning('Unable to save %s: %s' % (sidecar, ex))
+    def __request(self, headers=None):
+        "GET the url, returns a Deferred"
+        request_headers = Headers({b'User-Agent': [b'dman']})
+        for name, value in (headers or {}).items():
+            request_headers.setRawHeaders(name, [value])
+        return self.get_agent(self.dman).request(b'GET', self.request_url,
+                request_headers)
+    def __writer(self, response, fileobj, limit=None):
+        """Deliver the response body into fileobj, returns a Deferred
+        that fires once the body is written and the file closed"""
+        buf = self.free_buffers.pop() if self.free_buffers \
+                else bytearray(self.buffer_size)
+        finished = Deferred()
+        writer = BodyWriter(fileobj, buf, finished, limit, self.bucket)
+        response.deliverBody(writer)
+
+        def release(result):
+            self.free_buffers.append(buf)
+            if fileobj:
+                fileobj.close()
+            return result
+        finished.addBoth(release)
+        return writer, finished
+    def __response(self, response):
+        "Stream the response body into the .part file, or segment it"
+        if response.code >= 400:
+            self.__error = 'HTTP %d %s' % (response.code,
+                    response.phrase.decode('latin-1'))
+            return self.__writer(response, None)[1]
+
+        length = response.length
+        ranges = response.headers.getRawHeaders(b'accept-ranges') or []
+        count = max(1, self.dman.config_get('http_segments', 4,
+            self.dman.config.getint))
+        min_size = self.dman.config_get('http_segment_min_size',
+                64 * 1024 * 1024, self.dman.config.getint)
+        if self.__segmenting and response.code == 200 and \
+                b'bytes' in ranges and isinstance(length, (int, long)) and \
+                length > 0:
+            # A single segment still gets a sidecar, so it can resume
+            return self.__segment(response, length,
+                    count if length >= min_size else 1)
+        self.__body, finished = self.__writer(response,
+                open(self.path + '.part', 'wb'))
+        return finished
+    def __segment(self, response, length, count):
+        """Preallocate the .part file and split it in count segments,
+        the response body is used for the first segment"""
+        with open(self.path + '.part', 'wb') as fileobj:
+            fileobj.truncate(length)
+        size = -(-length // count)
+        self.segments = [ [start, start, min(start + size, length), None]
+                for start in range(0, length, size) ]
+        logging.debug('Downloading %s in %d segments' % (self.url,
+            len(self.segments)))
+        return self.__run_segments(response)
+    def __run_segments(self, response=None):
+        """Fetch the unfinished segments in parallel, returns a
+        Deferred that fires once all of them are written"""
+        self.__all = Deferred()
+        self.__running = 0
+        for segment in self.segments:
+            if segment[1] >= segment[2]:
+                continue
+            self.__running += 1
+            if response:
+                deferred = self.__segment_response(response, segment)
+                response = None
+            else:
+                deferred = segment[3] = self.__request({b'Range':
+                    b'bytes=%d-%d' % (segment[1], segment[2] - 1)})
+                deferred.addCallback(self.__range_response, segment)
+            deferred.addCallbacks(self.__segment_done, self.__segment_failed,
+                    callbackArgs=(segment,), errbackArgs=(segment,))
+        if response:
+            # Every segment is done, drop the connection
+            response.deliverBody(protocol.Protocol())
+        if self.__running:
+            self.save_segments()
+            self.__timer = reactor.callLater(self.checkpoint_interval,
+                    self.__checkpoint)
+        elif not self.__all.called:
+            self.__all.callback(None)
+        return self.__all
+    def __range_response(self, response, segment):
+        "Check the server honored the Range request"
+        if response.code != 206:
+            response.deliverBody(protocol.Protocol())
+            raise RangesUnsupported('HTTP %d for a range request' % response.code)
+        content_range = response.headers.getRawHeaders(b'content-range') or [b'']
+        if content_range[0].rpartition(b'/')[2] != b'%d' % self.segments[-1][2]:
+            response.deliverBody(protocol.Protocol())
+            raise RangesUnsupported('The file size changed')
+        return self.__segment_response(response, segment)
+    def __segment_response(self, response, segment):
+        "Write the body at the segment position"
+        fileobj = open(self.path + '.part', 'r+b', 0)
+        fileobj.seek(segment[1])
+        segment[3], finished = self.__writer(response, fileobj,
+                segment[2] - segment[1])
+        return finished
+    def __segment_progress(self, segment):
+        "Move the written bytes into the segment position"
+        writer, segment[3] = segment[3], None
+        if isinstance(writer, BodyWriter):
+            segment[1] += writer.written
+    def __segment_done(self, received, segment):
+        self.__segment_progress(segment)
+        if segment[1] < segment[2]:
+            return self.__segment_failed(
+                    IOError('Short read in %s' % self.url), segment)
+        self.__running -= 1
+        if not self.__running and not self.__all.called:
+            self.__all.callback(None)
+    def __segment_failed(self, failure, segment):
+        "The first failure stops the other segments"
+        self.__segment_progress(segment)
+        self.__running -= 1
+        if not self.__all.called:
+            segments = self.segments
+            self.__all.errback(failure)
+            self.__stop_segments(segments)
+    def __stop_segments(self, segments=None):
+        "Stop every running segment"
+        for segment in segments or self.segments:
+            if isinstance(segment[3], BodyWriter):
+                segment[3].transport.stopProducing()
+            elif segment[3]:
+                segment[3].cancel()
+    def __checkpoint(self):
+        "Save the segments progress, while segments are running"
+        self.__timer = None
+        if self.__running and not self.__finished:
+            self.save_segments()
+            self.__timer = reactor.callLater(self.checkpoint_interval,
+                    self.__checkpoint)
+    def __cleanup(self, keep=False):
+        """Stop the checkpoint timer and remove the .part file and
+        sidecar, a segmented .part file is kept for resuming"""
+        if self.__timer and self.__timer.active():
+            self.__timer.cancel()
+        self.__timer = None
+        if keep and self.segments:
+            self.save_segments()
+            return
+        for path in (self.path + '.part', self.path + '.part.segments'):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+    def __success(self, result):
+        if self.__error:
+            self.__cleanup()
+            self.__done(8)
+            return
+        if self.__timer and self.__timer.active():
+            self.__timer.cancel()
+        self.__timer = None
+        try:
+            os.rename(self.path + '.part', self.path)
+        except OSError as ex:
+            self.__error = 'Unable to rename %s: %s' % (self.path, ex)
+            self.__done(3)
+            return
+        if self.segments:
+            try:
+                os.unlink(self.path + '.part.segments')
+            except OSError:
+                pass
+        self.__done(0)
+    def __failure(self, failure):
+        if failure.check(RangesUnsupported) and not self.__stopped:
+            # Start over with a single stream
+            logging.info('%s: %s, not segmenting' % (self.url,
+                failure.getErrorMessage()))
+            self.__cleanup()
+            self.in_use.discard(self.path)
+            self.segments = None
+            self.__body = None
+            self.__segmenting = False
+            self.path = self.target_path()
+            self.__deferred = self.__request()
+            self.__deferred.addCallback(self.__response)
+            self.__deferred.addCallbacks(self.__success, self.__failure)
+            return
+
+        self.__cleanup(keep=self.__interrupted or not self.__stopped)
+        if self.__stopped:
+            self.__error = 'Cancelled'
+            self.__done(1)
+        elif failure.check(IOError, OSError):
+            self.__error = str(failure.value)
+            self.__done(3)
+        else:
+            self.__error = failure.getErrorMessage()
+            self.__done(4)
+    def __done(self, returncode):
+        self.__returncode = returncode
+        self.__finished = True
+        self.in_use.discard(self.path)
+        logging.debug('Download finished %s in %s %d' % (self.url,
+            self.save_in, returncode))
+        self.dman.download_finished(self)
+
+class PluginRegistry(object):
+    """The download plugins, in order of preference
+
+    Plugins are probed when a download needs one, not when
+    this module is imported. The available plugins are cached
+    for probe_interval seconds, after that they are probed
+    again so newly installed programs are picked up without
+    restarting dman (which() caches the PATH lookups)."""
+    probe_interval = 5
+
+    def __init__(self, plugins):
+        self.plugins = list(plugins)
+        self.__available = None
+        self.__probed = 0
+    def register(self, plugin):
+        "Add a plugin class, it is preferred over the known plugins"
+        self.plugins.insert(0, plugin)
+        self.__available = None
+    def load(self, name):
+        """Register a plugin class by its dotted name,
+        i.e. mypackage.plugins.MyDownload"""
+        module, _, attr = name.rpartition('.')
+        try:
+            plugin = getattr(importlib.import_module(module), attr)
+        except (ImportError, AttributeError, ValueError) as ex:
+            logging.warning('Unable to load plugin %s: %s' % (name, ex))
+            return None
+        self.register(plugin)
+        return plugin
+    def available(self):
+        "Returns the available plugin classes"
+        now = time.time()
+        if self.__available is None or now - self.__probed > self.probe_interval:
+            available = [ p for p in self.plugins if p.plugin_available() ]
+            if available != self.__available:
+                logging.info('Available plugins: %s' % ', '.join(
+                    p.__name__ for p in available))
+            self.__available = available
+            self.__probed = now
+        return self.__available
+    def choose(self, url, size=None):
+        """Returns the preferred plugin class for url or None
+
+        size is the expected file size, if known. A plugin that
+        prefers() url wins over the plugins listed before it"""
+        available = self.available()
+        for plugin in available:
+            if plugin.prefers(url, size):
+                return plugin
+        for plugin in available:
+            if plugin.supports(url, size):
+                return plugin
+        return None
+
+PLUGINS = [ AriaRpcDownload, AriaDownload, WGetDownload, HttpDownload ]
+REGISTRY = PluginRegistry(PLUGINS)
+BATCHES = { AriaDownload: AriaBatch, WGetDownload: WGetBatch }
+
+def new_download(dman, url, save_in, size=None):
+    "Returns a new Download object, or None if no plugin supports url"
+
+    plugin = REGISTRY.choose(url, size)
+    if not plugin:
+        return None
+    return plugin(dman, url, save_in)
+
+def batch_available(url, size=None):
+    "Returns True if new_batch() can be used for url"
+    return REGISTRY.choose(url, size) in BATCHES
 
-PLUGINS = [ AriaDownload, WGetDownload ]
-AVAILABLE = [ p for p in PLUGINS if p.plugin_available() ]
+def new_batch(dman, urls, save_in):
+    """Returns a list of Download objects, one for each url, that
+    are downloaded by a single process
 
-def new_download(dman, url, save_in):
-    "Returns a new Download object"
+    Start any of them to start the batch, the plugin is chosen
+    for the first url"""
 
-    if not AVAILABLE:
+    plugin = REGISTRY.choose(urls[0])
+    if plugin not in BATCHES:
         return None
-    return AVAILABLE[0](dman, url, save_in)
+    return BATCHES[plugin](dman, urls, save_in).downloads
 
@@ -0,0 +1,231 @@
+# coding: utf-8
+"""
+dman - download queues
+
+* QueueEntry is the record DMan keeps for each queued url
+* PendingQueue is the priority queue of entries waiting for
+  a download slot
+"""
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+from collections import deque, OrderedDict
+import time
+from .history import to_text
+
+def url_host(url):
+    """Returns the host name of a url, or '' if it has none
+
+    This is called for every queued url, it avoids the
+    overhead of urlparse
+
+    >>> print(url_host('http://Example.com:8080/file'))
+    example.com
+    >>> print(url_host('ftp://user:pw@[::1]:21/x?y#z'))
+    ::1
+    >>> print(url_host('/some/file'))
+    <BLANKLINE>
+    """
+    if isinstance(url, bytes):
+        url = url.decode('utf-8', 'replace')
+    start = url.find('://')
+    if start == -1:
+        return ''
+    start += 3
+    end = len(url)
+    for sep in '/?#':
+        idx = url.find(sep, start, end)
+        if idx != -1:
+            end = idx
+    host = url[start:end]
+    if '@' in host:
+        host = host.rpartition('@')[2]
+    if host.startswith('['):
+        host = host[1:].partition(']')[0]
+    else:
+        host = host.partition(':')[0]
+    return host.lower()
+
+class QueueEntry(object):
+    """A url in the DMan queues
+
+    The entry keeps its id from the moment the url is queued,
+    its state is one of STATES and download is the Download
+    object once the download was started"""
+    __slots__ = ('id', 'url', 'host', 'save_in', 'priority', 'state',
+            'download', 'seq', 'queued', 'started', 'attempts', 'partial',
+            'expected')
+    STATES = ('pending', 'downloading', 'verifying', 'retrying', 'finished',
+            'cancelled')
+
+    def __init__(self, entry_id, url, save_in, priority=0, expected=None):
+        self.id = entry_id
+        self.url = url
+        self.host = url_host(url)
+        self.save_in = save_in
+        self.priority = priority
+        self.state = 'pending'
+        self.download = None
+        self.queued = time.time()
+        self.started = None
+        # Number of retries after transient failures
+        self.attempts = 0
+        # The file an interrupted download left, as reported by
+        # the plugin, the next attempt continues it
+        self.partial = None
+        # The expected size and sha256, see dman.verify
+        self.expected = expected
+        # Set by PendingQueue while the entry is queued
+        self.seq = None
+
+    def status(self):
+        "Returns a dict describing this entry"
+        status = {
+            'id': self.id,
+            'url': to_text(self.url),
+            'save_in': to_text(self.save_in),
+            'priority': self.priority,
+            'state': self.state,
+            'queued': self.queued,
+            'started': self.started,
+            'attempts': self.attempts,
+            }
+        if self.download and self.download.finished():
+            status['succeeded'] = self.download.succeeded()
+            status['error'] = to_text(self.download.error())
+        elif self.download:
+            progress = self.download.progress()
+            if progress:
+                status['progress'] = progress
+        return status
+
+class PendingQueue(object):
+    """A priority queue of QueueEntry objects
+
+    Entries with higher priority are popped first. Within a
+    priority each host has its own FIFO deque and pop() goes
+    round-robin across hosts, so a large batch for one host
+    does not starve the others.
+
+    push() is O(1) unless a new priority is added, pop() only
+    visits hosts that are at their limit. remove() only marks
+    the entry and pop() skips it later.
+
+    >>> queue = PendingQueue()
+    >>> for entry_id, url, priority in [(1, 'http://a/1', 0),
+    ...         (2, 'http://a/2', 0), (3, 'http://b/1', 0),
+    ...         (4, 'http://a/3', 5), (5, 'http://b/2', 0)]:
+    ...     queue.push(QueueEntry(entry_id, url, '/tmp', priority))
+    >>> [ queue.pop().id for i in range(len(queue)) ]
+    [4, 1, 3, 2, 5]
+    """
+
+    def __init__(self):
+        # priority -> OrderedDict(host -> deque of (seq, entry))
+        self.__queues = {}
+        # priorities in use, sorted in descending order
+        self.__priorities = []
+        self.__seq = 0
+        self.__len = 0
+
+    def __len__(self):
+        return self.__len
+
+    def push(self, entry, front=False):
+        """Queue an entry, after all entries of the same priority
+        and host or before them if front is True"""
+        self.__seq += 1
+        entry.seq = self.__seq
+        hosts = self.__queues.get(entry.priority)
+        if hosts is None:
+            hosts = self.__queues[entry.priority] = OrderedDict()
+            self.__priorities.append(entry.priority)
+            self.__priorities.sort(reverse=True)
+        queue = hosts.get(entry.host)
+        if queue is None:
+            queue = hosts[entry.host] = deque()
+        if front:
+            queue.appendleft((entry.seq, entry))
+        else:
+            queue.append((entry.seq, entry))
+        self.__len += 1
+
+    def remove(self, entry):
+        "Remove a queued entry"
+        if entry.seq is not None:
+            entry.seq = None
+            self.__len -= 1
+
+    def pop(self, host_available=None):
+        """Remove and return the next entry
+
+        If given, host_available(host) must return True for hosts
+        that can start a new download. Returns None if there is no
+        entry that can be started"""
+        for priority in self.__priorities[:]:
+            hosts = self.__queues[priority]
+            entry = self.__pop_host(hosts, host_available)
+            if not hosts:
+                del self.__queues[priority]
+                self.__priorities.remove(priority)
+            if entry:
+                return entry
+        return None
+
+    def __pop_host(self, hosts, host_available):
+        """Pop the first live entry from the first available host
+        in hosts, the host then moves to the end of the rotation"""
+        empty = []
+        found = None
+        for host, queue in hosts.iteritems():
+            # Drop removed entries
+            while queue and queue[0][1].seq != queue[0][0]:
+                queue.popleft()
+            if not queue:
+                empty.append(host)
+            elif not host_available or host_available(host):
+                found = host
+                break
+        for host in empty:
+            del hosts[host]
+        if found is None:
+            return None
+
+        queue = hosts.pop(found)
+        entry = queue.popleft()[1]
+        entry.seq = None
+        self.__len -= 1
+        if queue:
+            hosts[found] = queue
+        return entry
+
+    def pop_similar(self, entry, count):
+        """Remove and return up to count entries queued right
+        after entry with the same priority, host and save_in
+
+        Used to group urls into a single download process, entries
+        with a partial file are downloaded on their own"""
+        hosts = self.__queues.get(entry.priority)
+        queue = hosts.get(entry.host) if hosts else None
+        result = []
+        while queue and len(result) < count:
+            seq, other = queue[0]
+            if other.seq != seq:
+                queue.popleft()
+                continue
+            if other.save_in != entry.save_in or other.partial:
+                break
+            queue.popleft()
+            other.seq = None
+            self.__len -= 1
+            result.append(other)
+        return result
+
+    def __iter__(self):
+        """Iterate the queued entries, by priority and host
+
+        This does not follow the round-robin order of pop()"""
+        for priority in self.__priorities:
+            for queue in self.__queues[priority].values():
+                for seq, entry in queue:
+                    if entry.seq == seq:
+                        yield entry
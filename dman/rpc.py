@@ -0,0 +1,184 @@
+# coding: utf-8
+"""
+dman - JSON-RPC 2.0 interface
+
+The ipc socket accepts JSON-RPC 2.0 requests, each request
+(or batch of requests) is written as a netstring and the
+response is sent back as a netstring. See DManRpc for the
+available methods.
+
+>>> rpc = DManRpc(None)
+>>> rpc.handle(b'{"jsonrpc": "2.0", "method": "nope", "id": 1}')
+'{"error": {"code": -32601, "message": "Method not found"}, "id": 1, "jsonrpc": "2.0"}'
+>>> rpc.handle(b'[]')
+'{"error": {"code": -32600, "message": "Invalid Request"}, "id": null, "jsonrpc": "2.0"}'
+
+A result that can not be serialized is an internal error of its call
+
+>>> rpc.rpc_bytes = lambda: b'\\xff'
+>>> rpc.handle(b'[{"jsonrpc": "2.0", "method": "bytes", "id": 1},'
+...     b' {"jsonrpc": "2.0", "method": "nope", "id": 2}]')
+'[{"error": {"code": -32603, "message": "Internal error"}, "id": 1, "jsonrpc": "2.0"}, {"error": {"code": -32601, "message": "Method not found"}, "id": 2, "jsonrpc": "2.0"}]'
+"""
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+import inspect
+import json
+import logging
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+
+# Maximum number of entries returned by a single list call
+MAX_LIMIT = 1000
+
+class JsonRpcError(Exception):
+    "An error to be returned as a JSON-RPC error object"
+    def __init__(self, code, message):
+        super(JsonRpcError, self).__init__(message)
+        self.code = code
+        self.message = message
+
+def check_ids(ids):
+    "Raise INVALID_PARAMS unless ids is a list of integers"
+    if not isinstance(ids, list) or \
+            not all(isinstance(i, (int, long)) for i in ids):
+        raise JsonRpcError(INVALID_PARAMS, 'ids must be a list of integers')
+
+class DManRpc(object):
+    """The JSON-RPC methods exported by the daemon
+
+    Methods named rpc_<name> are exported as <name>, all
+    methods taking ids operate on many entries at once"""
+
+    def __init__(self, dman):
+        self.dman = dman
+
+    def rpc_enqueue(self, urls, save_in=None, priority=0):
+        "Queue a list of urls, returns the list of new entry ids"
+        if not isinstance(urls, list) or \
+                not all(isinstance(url, basestring) for url in urls):
+            raise JsonRpcError(INVALID_PARAMS, 'urls must be a list of strings')
+        if save_in is not None and not isinstance(save_in, basestring):
+            raise JsonRpcError(INVALID_PARAMS, 'save_in must be a string')
+        if not isinstance(priority, (int, long)):
+            raise JsonRpcError(INVALID_PARAMS, 'priority must be an integer')
+        return self.dman.download_many(urls, save_in, priority)
+
+    def rpc_status(self, ids):
+        "Returns a list of status objects (or null for unknown ids)"
+        check_ids(ids)
+        return [ self.dman.status(entry_id) for entry_id in ids ]
+
+    def rpc_list(self, state='pending', offset=0, limit=100):
+        """List the entries in a queue (pending, downloading,
+        verifying, retrying or finished)
+
+        Returns {"total": <queue length>, "entries": [...]}"""
+        if state not in ('pending', 'downloading', 'verifying', 'retrying',
+                'finished'):
+            raise JsonRpcError(INVALID_PARAMS, 'Unknown queue: %s' % state)
+        if not isinstance(offset, (int, long)) or offset < 0 or \
+                not isinstance(limit, (int, long)) or limit < 0:
+            raise JsonRpcError(INVALID_PARAMS, 'Invalid offset or limit')
+        total, entries = self.dman.list_entries(state, offset,
+                min(limit, MAX_LIMIT))
+        return {'total': total, 'entries': entries}
+
+    def rpc_cancel(self, ids):
+        "Cancel entries, returns a list of booleans"
+        check_ids(ids)
+        return [ self.dman.cancel(entry_id) for entry_id in ids ]
+
+    def rpc_reprioritize(self, ids, priority):
+        "Change the priority of pending entries, returns a list of booleans"
+        check_ids(ids)
+        if not isinstance(priority, (int, long)):
+            raise JsonRpcError(INVALID_PARAMS, 'priority must be an integer')
+        return [ self.dman.reprioritize(entry_id, priority) for entry_id in ids ]
+
+    def call(self, request):
+        """Execute a single request object
+
+        Returns a response object, or None for notifications"""
+        if not isinstance(request, dict) or request.get('jsonrpc') != '2.0' \
+                or not isinstance(request.get('method'), basestring):
+            return error_response(None, INVALID_REQUEST, 'Invalid Request')
+
+        notification = 'id' not in request
+        try:
+            method = getattr(self, 'rpc_' + request['method'], None)
+            if not method:
+                raise JsonRpcError(METHOD_NOT_FOUND, 'Method not found')
+
+            params = request.get('params', [])
+            args, kwargs = [], {}
+            if isinstance(params, list):
+                args = params
+            elif isinstance(params, dict):
+                kwargs = dict((str(k), v) for k, v in params.items())
+            else:
+                raise JsonRpcError(INVALID_PARAMS,
+                        'Invalid params: params must be an array or an object')
+            # Only binding errors are INVALID_PARAMS, a TypeError
+            # raised by the method itself is an internal error
+            try:
+                inspect.getcallargs(method, *args, **kwargs)
+            except TypeError as ex:
+                raise JsonRpcError(INVALID_PARAMS, 'Invalid params: %s' % ex)
+            result = method(*args, **kwargs)
+        except JsonRpcError as ex:
+            if notification:
+                return None
+            return error_response(request['id'], ex.code, ex.message)
+        except Exception:
+            logging.exception('Error in json-rpc call')
+            if notification:
+                return None
+            return error_response(request['id'], INTERNAL_ERROR, 'Internal error')
+
+        if notification:
+            return None
+        return {'jsonrpc': '2.0', 'id': request['id'], 'result': result}
+
+    def handle(self, data):
+        """Handle a serialized request or batch
+
+        Returns the serialized response or None if there is
+        nothing to send back"""
+        try:
+            request = json.loads(data)
+        except ValueError:
+            response = error_response(None, PARSE_ERROR, 'Parse error')
+        else:
+            if isinstance(request, list):
+                if not request:
+                    response = error_response(None, INVALID_REQUEST, 'Invalid Request')
+                else:
+                    response = [ r for r in map(self.call, request) if r is not None ]
+                    if not response:
+                        return None
+                    return ('[%s]' % ', '.join(map(serialize, response))).encode('utf-8')
+            else:
+                response = self.call(request)
+                if response is None:
+                    return None
+        return serialize(response).encode('utf-8')
+
+def serialize(response):
+    """Serialize a response object, a result that is not valid
+    json (i.e. undecodable bytes) becomes an INTERNAL_ERROR"""
+    try:
+        return json.dumps(response, sort_keys=True)
+    except (TypeError, ValueError):
+        logging.exception('Unable to serialize json-rpc response')
+        return json.dumps(error_response(response.get('id'), INTERNAL_ERROR,
+            'Internal error'), sort_keys=True)
+
+def error_response(request_id, code, message):
+    "Build a JSON-RPC error response object"
+    return {'jsonrpc': '2.0', 'id': request_id,
+            'error': {'code': code, 'message': message}}
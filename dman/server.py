@@ -4,62 +4,89 @@ dman - local server classes
 """
 from __future__ import print_function, unicode_literals
 from __future__ import absolute_import, division
-import os, signal
-from .netstring import NetStringReader
+import os, signal, select, time, gc, random
+from itertools import islice
+from .netstring import NetStringReader, NetStringError, encode_many
 from twisted.internet import reactor, protocol
+from twisted.internet.defer import Deferred
 import sys
 import logging
-from .plugins import new_download
+from .plugins import REGISTRY, AriaRpcDownload, HttpDownload
+from .plugins import new_download, new_batch, batch_available
+from .paths import runtime_base_path, ipc_path, urldrop_path, stats_path
+from .rpc import DManRpc
+from .queues import QueueEntry, PendingQueue
+from .history import History, FinishedRecord
+from .journal import Journal
+from .dedup import DedupIndex
+from .adaptive import ConcurrencyController
+from .bandwidth import BandwidthBudget, parse_rate, parse_schedule
+from .verify import Verifier, split_expected
+from .metrics import METRICS
+from collections import OrderedDict
 import ConfigParser
 
-# Server
-def runtime_base_path():
-    """Returns the base path to store runtime info
-    if the path does not exist it is created
+URLDROP_FRAMES = METRICS.counter('dman_urldrop_frames_total',
+        'Urls received on the urldrop socket')
+URLDROP_BYTES = METRICS.counter('dman_urldrop_bytes_total',
+        'Bytes received on the urldrop socket')
+POKE_SECONDS = METRICS.histogram('dman_poke_seconds', 'Time spent in poke()',
+        (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1))
 
-    If the XDG_RUNTIME_DIR is not available
-    then /tmp/dman-<UID>/ is used"""
-
-    base = os.getenv('XDG_RUNTIME_DIR')
-    if base:
-        folder = os.path.join(base, 'dman')
-    else:
-        folder = "/tmp/dman-%s/" % os.getuid()
-
-    try:
-        os.mkdir(folder)
-    except OSError:
-        pass
-    return folder
+def shutdownDaemon(sig, stack):
+    """Stop the reactor, a signal received before reactor.run()
+    stops it as soon as it starts"""
+    reactor.callWhenRunning(reactor.stop)
 
-def ipc_path():
-    "The path to the ipc socket"
-    return os.path.join(runtime_base_path(), 'ipc')
+class NetStringProtocol(NetStringReader, protocol.Protocol):
+    """Base class for the netstring framed UNIX sockets
 
-def urldrop_path():
-    "The path to the urldrop socket"
-    return os.path.join(runtime_base_path(), 'urldrop')
+    Frames longer than max_length are rejected and the
+    connection is dropped"""
+    max_length = 64 * 1024
 
-def shutdownDaemon(sig, stack):
-    "Stop the reactor"
-    reactor.stop()
+    def __init__(self):
+        NetStringReader.__init__(self, max_length=self.max_length)
+    def dataReceived(self, data):
+        """Feed data into the netstring parser"""
+        try:
+            self.feed(data)
+        except NetStringError as ex:
+            logging.warning('Dropping %s connection: %s(%s)' % (
+                self.__class__.__name__, type(ex).__name__, ex))
+            self.transport.loseConnection()
 
-class UrlDropHandler(NetStringReader, protocol.Protocol):
+class UrlDropHandler(NetStringProtocol):
     """urldrop handler
     
     The urldrop ipc setups a UNIX socket where urls
     can be writen into. Each url is written as a netstring"""
+
     def __init__(self, dman):
-        NetStringReader.__init__(self)
+        NetStringProtocol.__init__(self)
         self.dman = dman
+
+    def connectionMade(self):
+        "The connection is paused while the pending queue is full"
+        self.dman.add_producer(self.transport)
+
+    def connectionLost(self, reason):
+        self.dman.remove_producer(self.transport)
+
     def dataReceived(self, data):
-        """Feed data into the netstring parser"""
-        self.feed(data)
+        URLDROP_BYTES.inc(len(data))
+        NetStringProtocol.dataReceived(self, data)
 
     def stringReceived(self, string):
         "Overrides the base class - pushes a url for download"
+        URLDROP_FRAMES.inc()
         self.dman.download(string)
 
+    def stringsReceived(self, strings):
+        "Overrides the base class - pushes a batch of urls for download"
+        URLDROP_FRAMES.inc(len(strings))
+        self.dman.download_many(strings)
+
 class UrlDropFactory(protocol.Factory):
     "urldrop socket factory"
     protocol = UrlDropHandler
@@ -69,30 +96,117 @@ class UrlDropFactory(protocol.Factory):
     def buildProtocol(self, addr):
         return UrlDropHandler(self.dman)
 
+class IpcHandler(NetStringProtocol):
+    """json-rpc ipc handler
+
+    Each netstring holds a JSON-RPC 2.0 request or batch,
+    responses are written back as netstrings"""
+    max_length = 16 * 1024 * 1024
+
+    def __init__(self, rpc):
+        NetStringProtocol.__init__(self)
+        self.rpc = rpc
+
+    def stringReceived(self, string):
+        "Overrides the base class - handles a request"
+        self.stringsReceived([string])
+
+    def stringsReceived(self, strings):
+        "Overrides the base class - answers all requests in a single write"
+        responses = [ self.rpc.handle(string) for string in strings ]
+        data = encode_many( r for r in responses if r is not None )
+        if data:
+            self.transport.write(data)
+
+class IpcFactory(protocol.Factory):
+    "ipc socket factory"
+    protocol = IpcHandler
+
+    def __init__(self, dman):
+        self.rpc = DManRpc(dman)
+    def buildProtocol(self, addr):
+        return IpcHandler(self.rpc)
+
+class StatsHandler(protocol.Protocol):
+    """stats socket handler
+
+    Each connection gets the metrics in the Prometheus text
+    format and is closed"""
+
+    def connectionMade(self):
+        self.transport.write(METRICS.render())
+        self.transport.loseConnection()
+
+class StatsFactory(protocol.Factory):
+    "stats socket factory"
+    protocol = StatsHandler
+
+# Seconds start_daemon() waits for the daemon to accept connections
+READY_TIMEOUT = 10
+
+def notify_ready(ready_fd):
+    """Tell the process that called start_daemon() that the
+    urldrop socket is accepting connections"""
+    try:
+        os.write(ready_fd, b'%d\n' % os.getpid())
+        os.close(ready_fd)
+    except OSError:
+        pass
+
+def wait_ready(ready_fd, timeout=READY_TIMEOUT):
+    """Wait for the daemon readiness notification
+
+    Returns the daemon pid or None if the daemon exited or
+    did not notify before the timeout"""
+    data = b''
+    deadline = time.time() + timeout
+    try:
+        while not data.endswith(b'\n'):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            readable, _, _ = select.select([ready_fd], [], [], remaining)
+            if not readable:
+                return None
+            chunk = os.read(ready_fd, 32)
+            if not chunk:
+                return None
+            data += chunk
+    finally:
+        os.close(ready_fd)
+    return int(data)
+
 def start_daemon():
     """Launch the dman daemon
 
-    If the dman daemon is not running, launch it and return True
+    If the dman daemon is not running, launch it and wait until
+    the urldrop socket accepts connections, the return value is
+    the daemon pid or None if the daemon failed to start.
     If the daemon is already running return False
 
     """
     if not os.path.exists(urldrop_path()):
-        # start dman
+        # start dman, the daemon writes its pid into the pipe
+        # once it is listening
+        ready_r, ready_w = os.pipe()
         pid = os.fork()
         if pid == 0:
             # child process
+            os.close(ready_r)
             os.setsid()
             sys.stdout = open("/dev/null", 'w')
             sys.stdin = open("/dev/null", 'r')
 
+            # The forked processes leave with os._exit(), SystemExit
+            # would unwind into the code that called start_daemon()
             try: 
                 pid = os.fork() 
                 if pid > 0:
                     # exit from second parent, print eventual PID before
-                    sys.exit(0) 
+                    os._exit(0)
             except OSError, ex: 
                 print("fork failed: ", ex)
-                sys.exit(1)
+                os._exit(1)
 
             # redirect standard file descriptors
             sys.stdout.flush()
@@ -104,38 +218,184 @@ def start_daemon():
             os.dup2(so.fileno(), sys.stdout.fileno())
             os.dup2(se.fileno(), sys.stderr.fileno())
 
-            main()
-            sys.exit(0) # Make sure we exit 
+            main(ready_fd=ready_w)
+            os._exit(0) # Make sure we exit 
+
+        os.close(ready_w)
+        os.waitpid(pid, 0)
+        return wait_ready(ready_r)
     else:
         return False
-    return True
 
 class DMan(object):
     """
     DMan the download manager interface daemon
     """
     
-    def __init__(self, maxdownloads=2):
-        self.pending = []
-        self.downloading = []
-        self.finished = []
-        self.maxdownloads = maxdownloads
-        self.save_in = DMan.default_download_path()
-
+    def __init__(self, maxdownloads=2, maxdownloads_per_host=0):
+        self.pending = PendingQueue()
+        self.downloading = OrderedDict()
+        self.entries = {}
+        # running processes (Download or BatchProcess) -> host,
+        # each one takes a download slot
+        self.running = {}
+        # number of running processes per host
+        self.host_downloads = {}
+        # Set by stop_downloads(), fires once they all stopped
+        self.stopping = None
+
+        self.config = ConfigParser.ConfigParser()
         try:
-            config = ConfigParser.ConfigParser()
             cfp = open(DMan.config_path())
-            config.readfp( cfp, 'dman.cfg')
-            self.save_in = os.path.expanduser(config.get('dman', 'save_in'))
+            self.config.readfp( cfp, 'dman.cfg')
         except IOError:
             logging.info('No config file was found in ' + DMan.config_path())
 
+        if self.config.has_option('dman', 'save_in'):
+            self.save_in = os.path.expanduser(self.config.get('dman', 'save_in'))
+        else:
+            self.save_in = DMan.default_download_path()
+        self.maxdownloads = self.config_get('maxdownloads', maxdownloads,
+                self.config.getint)
+        # 0 means no per host limit
+        self.maxdownloads_per_host = self.config_get('maxdownloads_per_host',
+                maxdownloads_per_host, self.config.getint)
+        # Maximum number of urls downloaded by a single process,
+        # 1 starts a process for each url
+        self.batch_size = self.config_get('batch_size', 1, self.config.getint)
+        # urldrop connections stop being read once the pending
+        # queue reaches the high watermark, until it drops below
+        # the low watermark. 0 disables it
+        self.high_watermark = self.config_get('pending_high_watermark',
+                1000000, self.config.getint)
+        self.low_watermark = self.config_get('pending_low_watermark',
+                self.high_watermark // 2, self.config.getint)
+        self.producers = set()
+        self.paused = False
+
+        # Transient failures are retried up to max_retries times,
+        # see __retry_later()
+        self.max_retries = self.config_get('max_retries', 3, self.config.getint)
+        self.retry_delay = self.config_get('retry_delay', 10, self.config.getfloat)
+        self.retry_max_delay = self.config_get('retry_max_delay', 900,
+                self.config.getfloat)
+        # host -> entries waiting for the host backoff timer
+        self.retrying = {}
+        # host -> consecutive failures
+        self.host_failures = {}
+        # Files are checked against the size and sha256 queued with
+        # their url, in verify_threads threads
+        self.verifier = Verifier(self.config_get('verify_threads', 2,
+            self.config.getint))
+        # entry id -> entries whose file is being checked
+        self.verifying = OrderedDict()
+        # A single aria2c over rpc, instead of a process per url or batch
+        AriaRpcDownload.enabled = self.config_get('aria2_rpc', False,
+                self.config.getboolean)
+        # Large files with a known size to the built-in http downloader
+        HttpDownload.prefer_min_size = self.config_get('http_prefer_min_size',
+                0, self.config.getint)
+        # Third party plugins, preferred over the builtin ones
+        for name in self.config_get('plugins', '').split():
+            REGISTRY.load(name)
+
+        self.finished = History(
+                os.path.expanduser(self.config_get('history_file',
+                    DMan.default_history_path())),
+                self.config_get('history_size', 1000, self.config.getint),
+                self.config_get('history_age', 0, self.config.getint))
+        self.last_id = self.finished.last_id
+        # Without finished downloads append() never trims by age
+        if self.finished.max_age:
+            reactor.callLater(self.history_interval(), self.history_tick)
+
+        # The journal is disabled if journal_file is empty
+        journal_file = self.config_get('journal_file', DMan.default_journal_path())
+        if journal_file:
+            self.journal = Journal(os.path.expanduser(journal_file),
+                    reactor.callLater, self.entries.values,
+                    self.config_get('journal_commit_interval', 0.1,
+                        self.config.getfloat))
+        else:
+            self.journal = None
+
+        # skip, missing or force, see dman.dedup
+        policy = self.config_get('dedup', 'missing')
+        if policy == 'force':
+            self.dedup = None
+        else:
+            self.dedup = DedupIndex(policy, self.finished.max_records,
+                    self.config_get('dedup_filter_bits', 8 * 1024 * 1024,
+                        self.config.getint),
+                    os.path.join(os.path.dirname(DMan.config_path()),
+                        'dedup.filter'))
+
+        # The total rate limit, split across the running downloads
+        self.bandwidth = BandwidthBudget(
+                parse_rate(self.config_get('max_rate', '0')),
+                parse_schedule(self.config_get('rate_schedule', '')))
+        self.rate_limited = False
+        if self.bandwidth.schedule:
+            reactor.callLater(60, self.bandwidth_tick)
+
+        # Tune maxdownloads from the measured throughput
+        self.controller = None
+        if self.config_get('adaptive', False, self.config.getboolean):
+            self.controller = ConcurrencyController(self.maxdownloads,
+                    self.config_get('adaptive_min', 1, self.config.getint),
+                    self.config_get('adaptive_max', 16, self.config.getint))
+            self.maxdownloads = self.controller.slots
+            self.adaptive_interval = self.config_get('adaptive_interval', 10,
+                    self.config.getfloat)
+            self.__progress = {}
+            self.__measured = time.time()
+            reactor.callLater(self.adaptive_interval, self.adapt)
+
+        # Queue depths, only computed when the metrics are read
+        METRICS.gauge('dman_pending', 'Urls waiting for a download slot',
+                lambda: len(self.pending))
+        METRICS.gauge('dman_downloading', 'Running downloads',
+                lambda: len(self.downloading))
+        METRICS.gauge('dman_verifying', 'Downloads being verified',
+                lambda: len(self.verifying))
+        METRICS.gauge('dman_retrying', 'Downloads waiting for a retry',
+                lambda: sum(len(entries) for entries in self.retrying.values()))
+        METRICS.gauge('dman_processes', 'Download slots in use',
+                lambda: len(self.running))
+        METRICS.gauge('dman_maxdownloads', 'Download slots',
+                lambda: self.maxdownloads)
+        # The metrics are also written into metrics_file, if set
+        self.metrics_file = os.path.expanduser(self.config_get('metrics_file', ''))
+        if self.metrics_file:
+            self.metrics_interval = self.config_get('metrics_interval', 15,
+                    self.config.getfloat)
+            reactor.callLater(self.metrics_interval, self.write_metrics)
+
+    def config_get(self, option, default, get=None):
+        """Read an option from the [dman] section of the config file
+
+        get is the ConfigParser getter to use, i.e. config.getint,
+        if the option is not set default is returned"""
+        if not self.config.has_option('dman', option):
+            return default
+        return (get or self.config.get)('dman', option)
+
     @staticmethod
     def config_path():
         "Path to the config file"
         base = os.path.expanduser("~")
         return os.path.join(base, '.dman', 'dman.cfg')
 
+    @staticmethod
+    def default_history_path():
+        "Path to the file holding older finished downloads"
+        return os.path.join(os.path.dirname(DMan.config_path()), 'history')
+
+    @staticmethod
+    def default_journal_path():
+        "Path to the queue journal"
+        return os.path.join(os.path.dirname(DMan.config_path()), 'journal')
+
     @staticmethod
     def default_download_path():
         "Returns a default download folder"
@@ -147,8 +407,73 @@ class DMan(object):
             pass
         return path
 
-    def download(self, url, save_path=None):
-        "Download a URL"       
+    def __queue(self, url, save_path, priority):
+        """Create a new entry and add it to the pending queue
+
+        Returns the new entry id. For duplicate urls no entry is
+        created, the id of the existing download is returned or
+        None if it is unknown. Urls with invalid expected size or
+        sha256 fields (see dman.verify) are not queued"""
+        try:
+            url, expected = split_expected(url)
+        except ValueError as ex:
+            logging.warning('Not queueing %s: %s' % (url, ex))
+            return None
+        if self.dedup:
+            duplicate = self.dedup.check(url, save_path)
+            if duplicate is not None:
+                logging.debug('Skipping duplicate url %s' % url)
+                return duplicate or None
+
+        self.last_id += 1
+        entry = QueueEntry(self.last_id, url, save_path, priority, expected)
+        self.entries[entry.id] = entry
+        self.pending.push(entry)
+        if self.dedup:
+            self.dedup.add(url, entry.id)
+        if self.journal:
+            self.journal.add(entry)
+        return entry.id
+
+    def restore(self):
+        """Rebuild the pending queue from the journal
+
+        Downloads that were running when dman stopped are queued
+        again, they continue their partial files. Returns the number
+        of restored entries"""
+        if not self.journal:
+            return 0
+
+        # Millions of new objects would trigger the cyclic
+        # garbage collector over and over, none of them are garbage
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            restored = self.journal.replay()
+            entries = self.entries
+            push = self.pending.push
+            for entry_id, priority, save_in, url, partial, expected in restored:
+                entry = QueueEntry(entry_id, url, save_in, priority, expected)
+                entry.partial = partial
+                entries[entry_id] = entry
+                push(entry)
+                if self.dedup:
+                    self.dedup.add(url, entry_id)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        if restored:
+            self.last_id = max(self.last_id, restored[-1][0])
+        self.journal.compact_if_needed()
+        logging.info('Restored %d downloads from the journal' % len(restored))
+        self.poke()
+        return len(restored)
+
+    def download(self, url, save_path=None, priority=0):
+        """Download a URL
+
+        Returns the id of the new queue entry, see __queue()
+        for duplicate urls"""
 
         if not save_path:
             save_path = self.save_in
@@ -156,66 +481,500 @@ class DMan(object):
         logging.info("Adding %s to the download queue in %s" % (url, save_path))
         #
         # dman has three queues (pending, downloading, finished)
-        # - pending is a queue of tuples (url, save_folder)
-        # - downloading is a queue of Download objects
-        # - finished is a queue of download objects
+        # - pending is a PendingQueue of QueueEntry objects
+        # - downloading maps running Download objects to their entries
+        # - finished is the History of FinishedRecord objects
+        #
+        # entries maps entry ids to pending or running entries
 
         # Add download to the pending queue
-        self.pending.append( (url, save_path) )
+        entry_id = self.__queue(url, save_path, priority)
         self.poke()
+        return entry_id
+
+    def download_many(self, urls, save_path=None, priority=0):
+        """Download a list of URLs
+
+        Same as download() but the queue is only poked once,
+        returns the list of new entry ids"""
+
+        if not save_path:
+            save_path = self.save_in
+
+        logging.info("Adding %d urls to the download queue in %s" % (len(urls), save_path))
+        ids = [ self.__queue(url, save_path, priority) for url in urls ]
+        self.poke()
+        return ids
+
+    def status(self, entry_id):
+        "Returns the status dict for an entry or None if there is no such entry"
+        entry = self.entries.get(entry_id) or self.finished.get(entry_id)
+        if not entry:
+            return None
+        return entry.status()
+
+    def list_entries(self, state, offset=0, limit=None):
+        """List the entries in a queue (pending, downloading,
+        verifying, retrying or finished)
+
+        Pending entries are listed in the order they will be started.
+        Returns a tuple (total, statuses)"""
+        if state == 'pending':
+            queue = self.pending
+        elif state == 'downloading':
+            queue = self.downloading.values()
+        elif state == 'verifying':
+            queue = self.verifying.values()
+        elif state == 'retrying':
+            queue = [ entry for entries in self.retrying.values()
+                    for entry in entries ]
+        elif state == 'finished':
+            stop = None if limit is None else offset + limit
+            return len(self.finished), [ record.status()
+                    for record in self.finished.slice(offset, stop) ]
+        else:
+            raise ValueError('Unknown queue: %s' % state)
+
+        stop = None if limit is None else offset + limit
+        return len(queue), [ entry.status()
+                for entry in islice(queue, offset, stop) ]
+
+    def cancel(self, entry_id):
+        """Cancel a pending or running download
+
+        Returns False if there is no such entry or it is finished"""
+        entry = self.entries.get(entry_id)
+        if not entry or entry.state in ('finished', 'cancelled'):
+            return False
+
+        logging.info("Cancelling %s" % entry.url)
+        if entry.state == 'pending':
+            self.pending.remove(entry)
+            entry.state = 'cancelled'
+            self.__finish(entry)
+            self.flow_control()
+        elif entry.state == 'retrying':
+            self.retrying[entry.host].remove(entry)
+            entry.state = 'cancelled'
+            self.__finish(entry)
+        elif entry.state == 'verifying':
+            # __verified() finishes it
+            entry.state = 'cancelled'
+        else:
+            # download_finished() moves it into finished once it stops
+            entry.state = 'cancelled'
+            entry.download.stop()
+        return True
+
+    def reprioritize(self, entry_id, priority):
+        """Change the priority of a pending entry
+
+        Returns False if the entry is not pending"""
+        entry = self.entries.get(entry_id)
+        if not entry or entry.state != 'pending':
+            return False
+
+        self.pending.remove(entry)
+        entry.priority = priority
+        self.pending.push(entry)
+        if self.journal:
+            self.journal.reprioritize(entry)
+        return True
+
+    def download_finished(self, download):
+        """Called by Download objects when they finish
+
+        Moves the download into the finished queue, files with an
+        expected size or sha256 are verified first, and starts
+        pending downloads"""
+        entry = self.downloading.pop(download, None)
+        if entry:
+            if download.succeeded():
+                self.host_failures.pop(entry.host, None)
+            if self.stopping and entry.state != 'cancelled' and \
+                    not download.succeeded():
+                # Interrupted by stop_downloads(), the entry stays in
+                # the journal and the next run continues its file
+                self.__record_partial(entry, download)
+            elif entry.expected and entry.state != 'cancelled' and \
+                    download.succeeded():
+                self.__verify(entry, download)
+            elif entry.state != 'cancelled' and download.transient_failure() \
+                    and entry.attempts < self.max_retries:
+                logging.info('%s failed: %s' % (entry.url, download.error()))
+                self.__record_partial(entry, download)
+                self.__retry_later(entry)
+            else:
+                if entry.state != 'cancelled':
+                    entry.state = 'finished'
+                self.__finish(entry)
+        if download.batch is None:
+            self.__release(download)
+        self.poke()
+        if self.stopping and not self.downloading and not self.stopping.called:
+            self.stopping.callback(None)
+
+    def __record_partial(self, entry, download):
+        """Remember the file an interrupted download wrote, the next
+        attempt continues it. Only a path the plugin reported is
+        used, a guessed file name may belong to another download"""
+        path = download.output_path(guess=False)
+        if path and path != entry.partial:
+            entry.partial = path
+            if self.journal:
+                self.journal.start(entry)
+
+    def __verify(self, entry, download):
+        """Check the downloaded file against the expected size and
+        sha256, the download slot is released meanwhile"""
+        entry.state = 'verifying'
+        self.verifying[entry.id] = entry
+        # A guessed file name may be another file, i.e. when wget
+        # added a .1 suffix
+        path = download.output_path(guess=False)
+        if not path:
+            self.__verified('The downloaded file is unknown', entry, download)
+            return
+        logging.debug('Verifying %s' % path)
+        self.verifier.verify(path, entry.expected).addCallback(
+                self.__verified, entry, download)
+
+    def __verified(self, error, entry, download):
+        "The verifier is done with the file of entry"
+        del self.verifying[entry.id]
+        if error:
+            logging.warning('%s failed verification: %s' % (entry.url, error))
+            download.verify_error = error
+        if entry.state != 'cancelled':
+            entry.state = 'finished'
+        self.__finish(entry)
+
+    def __retry_later(self, entry):
+        """Put an entry that failed with a transient error aside
+
+        Failures for the same host share a single backoff timer and
+        the host gets no new downloads until it fires, then all its
+        failed entries go back into the pending queue. The jittered
+        delay doubles with each consecutive failure of the host"""
+        entry.attempts += 1
+        entry.state = 'retrying'
+        entry.download = None
+        failures = self.host_failures[entry.host] = \
+                self.host_failures.get(entry.host, 0) + 1
+        waiting = self.retrying.get(entry.host)
+        if waiting is None:
+            delay = min(self.retry_max_delay,
+                    self.retry_delay * 2 ** min(failures - 1, 32))
+            delay *= random.uniform(0.5, 1.5)
+            logging.info('Retrying downloads from %s in %.0fs' % (entry.host, delay))
+            waiting = self.retrying[entry.host] = []
+            reactor.callLater(delay, self.__retry_host, entry.host)
+        waiting.append(entry)
+
+    def __retry_host(self, host):
+        "The backoff timer for host fired, queue its entries again"
+        for entry in self.retrying.pop(host, []):
+            entry.state = 'pending'
+            self.pending.push(entry)
+        self.poke()
+
+    def batch_finished(self, batch):
+        """Called by BatchProcess objects when their process exits,
+        after download_finished() was called for each url"""
+        self.__release(batch)
+        self.poke()
+
+    def __release(self, process):
+        "Free the download slot taken by a Download or BatchProcess"
+        host = self.running.pop(process, None)
+        if host is None:
+            return
+        self.host_downloads[host] -= 1
+        if not self.host_downloads[host]:
+            del self.host_downloads[host]
+
+    def __finish(self, entry, error=None):
+        """Replace a finished or cancelled entry with a compact record
+        in the history, the Download object is released. error is
+        the reason an entry without a download failed"""
+        del self.entries[entry.id]
+        if self.journal:
+            self.journal.remove(entry)
+        record = FinishedRecord.from_entry(entry, error=error)
+        if self.dedup:
+            self.dedup.finish(entry.url, entry.id, record.succeeded)
+        self.finished.append(record)
+        entry.download = None
+
+    def stop_downloads(self, timeout=10):
+        """Interrupt the running downloads before the reactor stops,
+        no new ones are started. Returns a Deferred that fires once
+        all of them exited, or after timeout seconds"""
+        self.stopping = Deferred()
+        if not self.downloading:
+            self.stopping.callback(None)
+            return self.stopping
+        logging.info('Stopping %d downloads' % len(self.downloading))
+        for download in list(self.downloading):
+            download.interrupt()
+
+        def expired():
+            if not self.stopping.called:
+                logging.warning('%d downloads did not stop in %ds'
+                        % (len(self.downloading), timeout))
+                self.stopping.callback(None)
+        timer = reactor.callLater(timeout, expired)
+        self.stopping.addBoth(lambda result: timer.active() and timer.cancel())
+        return self.stopping
+
+    def close(self):
+        """Save the history, journal and dedup index before exiting,
+        interrupted downloads continue their files after a restart.
+        Call stop_downloads() first, downloads that did not stop are
+        recorded as they are"""
+        for download, entry in self.downloading.items():
+            self.__record_partial(entry, download)
+        self.finished.close()
+        if self.journal:
+            self.journal.close()
+        if self.dedup:
+            self.dedup.close()
+
+    def add_producer(self, transport):
+        "Register a urldrop connection for flow control"
+        self.producers.add(transport)
+        if self.paused:
+            transport.pauseProducing()
+
+    def remove_producer(self, transport):
+        "Forget a closed urldrop connection"
+        self.producers.discard(transport)
+
+    def flow_control(self):
+        """Pause reading from the urldrop connections above the high
+        watermark, resume once the pending queue is below the low
+        watermark. Producers block, no urls are dropped"""
+        if not self.high_watermark:
+            return
+        if not self.paused and len(self.pending) >= self.high_watermark:
+            logging.info('%d pending downloads, pausing urldrop' % len(self.pending))
+            self.paused = True
+            for transport in self.producers:
+                transport.pauseProducing()
+        elif self.paused and len(self.pending) < self.low_watermark:
+            logging.info('%d pending downloads, resuming urldrop' % len(self.pending))
+            self.paused = False
+            for transport in list(self.producers):
+                transport.resumeProducing()
 
     def poke(self):
         """
-        Poke dman to "do something", this function moves
-        finished downloads into the finished queue and
+        Poke dman to "do something", this function
         starts pending downloads
         """
-        # Moved finished downloads out
+        started = time.time()
+        self.__start_pending()
+        self.share_bandwidth()
+        self.flow_control()
+        POKE_SECONDS.observe(time.time() - started)
+
+    def fixed_rates(self, exclude=None):
+        "The bytes/s taken by running processes with a fixed_rate"
+        return sum(process.rate_limit for process in self.running
+                if process.fixed_rate and process is not exclude)
+
+    def share_bandwidth(self):
+        """Split what the fixed_rate processes left of the bandwidth
+        budget across the other running processes, called when
+        downloads start or finish. Without a limit there is nothing
+        to do once every process runs unlimited"""
+        limit = self.bandwidth.limit()
+        if not limit and not self.rate_limited:
+            return
+        self.rate_limited = bool(limit)
+        adjustable = [ process for process in self.running if not process.fixed_rate ]
+        # Never less than the share of one slot, even when the schedule
+        # lowered the limit below what the fixed_rate processes hold
+        share = max(self.bandwidth.share(len(adjustable), taken=self.fixed_rates()),
+                self.bandwidth.share(self.maxdownloads))
+        for process in adjustable:
+            process.set_rate_limit(share)
+
+    def write_metrics(self):
+        "Write metrics_file, runs every metrics_interval seconds"
+        tmp = self.metrics_file + '.tmp'
+        try:
+            with open(tmp, 'wb') as fileobj:
+                fileobj.write(METRICS.render())
+            os.rename(tmp, self.metrics_file)
+        except (IOError, OSError) as ex:
+            logging.warning('Unable to write %s: %s' % (self.metrics_file, ex))
+        reactor.callLater(self.metrics_interval, self.write_metrics)
+
+    def history_interval(self):
+        "Seconds between history trims, at most a minute"
+        return max(1, min(60, self.finished.max_age))
+
+    def history_tick(self):
+        "Move records older than history_age out of memory"
+        self.finished.trim()
+        reactor.callLater(self.history_interval(), self.history_tick)
+
+    def bandwidth_tick(self):
+        "Apply the bandwidth schedule, runs every minute"
+        self.share_bandwidth()
+        reactor.callLater(60, self.bandwidth_tick)
+
+    def __start_pending(self):
+        """Move pending downloads in, round-robin across
+        the hosts that are below their limit"""
+        if self.stopping or not REGISTRY.available():
+            return
+        # Entries that could not be started, back to pending
+        requeue = []
+        while self.pending and len(self.running) < self.maxdownloads:
+            entry = self.pending.pop(self.host_available)
+            if not entry:
+                break
+
+            # Urls queued after entry for the same host and
+            # folder share its process, unless it has a partial
+            # file that needs its own output name
+            entries = [entry]
+            size = entry.expected.get('size') if entry.expected else None
+            if self.batch_size > 1 and not entry.partial and \
+                    batch_available(entry.url, size):
+                entries.extend(self.pending.pop_similar(entry, self.batch_size - 1))
+            try:
+                if len(entries) > 1:
+                    downloads = new_batch( self, [ e.url for e in entries ], entry.save_in )
+                else:
+                    download = new_download( self, entry.url, entry.save_in, size )
+                    downloads = [download] if download else None
+            except Exception:
+                logging.exception('Unable to create a download for %s' % entry.url)
+                requeue.extend(entries)
+                continue
+            if not downloads and len(entries) == 1:
+                # No available plugin supports the url, popping it
+                # again on every poke() would never change that
+                logging.info('No plugin for %s' % entry.url)
+                entry.state = 'finished'
+                self.__finish(entry, 'Unsupported url')
+                continue
+            if not downloads:
+                requeue.extend(entries)
+                continue
+
+            process = downloads[0].batch or downloads[0]
+            if process.fixed_rate:
+                # Processes that can't change their limit later get
+                # the share of one slot, never what is left over
+                rate = self.bandwidth.share(self.maxdownloads)
+                if rate and self.bandwidth.share(1, taken=self.fixed_rates()) < rate:
+                    # maxdownloads grew or the schedule lowered the
+                    # limit, wait for a running process to finish
+                    requeue.extend(entries)
+                    break
+                process.set_rate_limit(rate)
+            # Continue the partial file of an earlier attempt
+            downloads[0].partial = entry.partial
+            self.running[process] = entry.host
+            self.host_downloads[entry.host] = self.host_downloads.get(entry.host, 0) + 1
+            started = time.time()
+            for entry, download in zip(entries, downloads):
+                entry.download = download
+                entry.state = 'downloading'
+                entry.started = started
+                self.downloading[download] = entry
+            try:
+                downloads[0].start()
+            except Exception:
+                # i.e. the process could not be spawned, the entries
+                # fail instead of holding the slot forever
+                logging.exception('Unable to start %s' % entry.url)
+                self.__release(process)
+                for entry, download in zip(entries, downloads):
+                    del self.downloading[download]
+                    entry.state = 'finished'
+                    self.__finish(entry)
+
+        for entry in reversed(requeue):
+            self.pending.push(entry, front=True)
+
+    def adapt(self):
+        """Measure the aggregate throughput of the running downloads
+        and let the controller set maxdownloads, runs every
+        adaptive_interval seconds
+
+        Only downloads that report progress() are measured"""
+        now = time.time()
+        elapsed, self.__measured = now - self.__measured, now
+        received = 0
+        progress = {}
         for download in self.downloading:
-            if download.finished():
-                self.downloading.remove(download)
-                self.finished.append(download)
-
-        # Move pending downloads in
-        count = min( len(self.pending), 
-                self.maxdownloads - len(self.downloading))
-        if count:
-            for i in range(count):
-                d_url, d_save_in = self.pending.pop()
-                download = new_download( self, d_url, d_save_in )
-                if not download:
-                    # Can't start the download - got back to pending
-                    self.pending.append( (d_url, d_save_in) )
-                    continue
-
-                self.downloading.append(download)
-                download.start()
-
-
-def main():
+            current = download.progress()
+            if current:
+                progress[download] = current['bytes']
+                received += max(0, current['bytes'] - self.__progress.get(download, 0))
+        self.__progress = progress
+
+        if progress and elapsed > 0:
+            busy = bool(self.pending) and len(self.running) >= self.maxdownloads
+            self.maxdownloads = self.controller.update(received / elapsed, busy)
+            self.poke()
+        reactor.callLater(self.adaptive_interval, self.adapt)
+
+    def host_available(self, host):
+        """Returns True if host is below the per host download limit
+        and is not waiting for a retry"""
+        if host in self.retrying:
+            return False
+        return not self.maxdownloads_per_host or \
+                self.host_downloads.get(host, 0) < self.maxdownloads_per_host
+
+
+def main(ready_fd=None):
     """main() function to execute the server
     
     Params:
-    * urls: a list of urls to push into the download queue
+    * ready_fd: a file descriptor, the daemon pid is written into it
+      as soon as the urldrop socket is listening, see start_daemon()
     """
 
     if os.path.exists(urldrop_path()):
         print("The server is already running")
+        if ready_fd is not None:
+            os.close(ready_fd)
         return
 
     logging.basicConfig(filename=os.path.join(runtime_base_path(), 'dman.log'), 
                         level=logging.DEBUG)
     logging.info("Starting dman")
     dman = DMan()
+    dman.restore()
     signal.signal(signal.SIGTERM, shutdownDaemon)
     signal.signal(signal.SIGINT, shutdownDaemon)
     reactor.listenUNIX( urldrop_path(), UrlDropFactory(dman) )
+    for path in (ipc_path(), stats_path()):
+        try:
+            # A stale socket is left behind if the daemon crashed
+            os.unlink(path)
+        except OSError:
+            pass
+    reactor.listenUNIX( ipc_path(), IpcFactory(dman) )
+    reactor.listenUNIX( stats_path(), StatsFactory() )
+    if ready_fd is not None:
+        # listenUNIX() is already listening, clients can connect
+        notify_ready(ready_fd)
 
+    reactor.addSystemEventTrigger('before', 'shutdown', dman.stop_downloads)
     reactor.run()
     logging.info("Shutting down")
-    try:
-        os.unlink(ipc_path())
-        os.unlink(urldrop_path())
-    except OSError:
-        pass
+    dman.close()
+    for path in (ipc_path(), stats_path(), urldrop_path()):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
 
@@ -0,0 +1,115 @@
+# coding: utf-8
+"""
+dman - download verification
+
+A queued url can carry the expected size and SHA-256 of its
+file, as whitespace separated fields after the url (urls never
+contain whitespace), in every ingest path (urldrop, json-rpc
+and url lists):
+
+    http://example.com/file.iso sha256=<hex digest> size=<bytes>
+
+Finished downloads with expectations are checked by a Verifier.
+Files are hashed in a small thread pool, so hashing a large file
+does not stall the reactor and the urldrop and ipc sockets.
+"""
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+import hashlib
+import os
+import re
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+SHA256_RE = re.compile(r'^[0-9a-fA-F]{64}$')
+# A trailing <name>=<value> field, after whitespace
+FIELD_RE = re.compile(br'^(.*?)\s+(\w+)=(\S*)\s*$', re.S)
+
+def split_expected(text):
+    """Split a queued url into the url and a dict with its expected
+    size and sha256, or None
+
+    Only trailing name=value fields are split off, other text stays
+    in the url. Raises ValueError for unknown or invalid fields
+
+    >>> url, expected = split_expected('http://a/b  size=10 sha256=' + 'AB' * 32)
+    >>> print(url, expected['size'], expected['sha256'][:4])
+    http://a/b 10 abab
+    >>> split_expected('http://a/b')[1] is None
+    True
+    >>> print(split_expected('http://a/my file.iso')[0])
+    http://a/my file.iso
+    >>> split_expected('http://a/b md5=0')
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid field u'md5=0'
+    """
+    # Urls from the urldrop are bytes
+    if b' ' not in text and b'\t' not in text:
+        return text, None
+    expected = {}
+    while True:
+        match = FIELD_RE.match(text)
+        if not match:
+            break
+        text, name, value = match.groups()
+        if name.lower() == 'size' and value.isdigit():
+            expected.setdefault('size', int(value))
+        elif name.lower() == 'sha256' and SHA256_RE.match(value):
+            expected.setdefault('sha256', value.lower())
+        else:
+            raise ValueError('Invalid field %r' % (name + b'=' + value))
+    return text, expected or None
+
+def file_digest(path, name='sha256', buffer_size=1024 * 1024):
+    """Returns the hex digest of a file
+
+    The file is read with readinto() into a single buffer,
+    hashlib releases the GIL while it hashes each block"""
+    digest = hashlib.new(name)
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    with open(path, 'rb', 0) as fileobj:
+        while True:
+            count = fileobj.readinto(buf)
+            if not count:
+                break
+            digest.update(view[:count])
+    return digest.hexdigest()
+
+def check_file(path, expected, buffer_size=1024 * 1024):
+    """Returns None if the file at path matches expected, otherwise
+    an error message. This blocks, it runs in the Verifier threads"""
+    try:
+        size = os.path.getsize(path)
+        if 'size' in expected and size != expected['size']:
+            return 'Size mismatch, got %d bytes instead of %d' % (size,
+                    expected['size'])
+        if 'sha256' in expected:
+            digest = file_digest(path, 'sha256', buffer_size)
+            if digest != expected['sha256']:
+                return 'SHA-256 mismatch, got %s' % digest
+    except (IOError, OSError) as ex:
+        return 'Unable to verify %s: %s' % (path, ex)
+    return None
+
+class Verifier(object):
+    """Check downloaded files in a pool of up to threads threads
+
+    The pool is started by the first verification"""
+
+    def __init__(self, threads=2, buffer_size=1024 * 1024):
+        self.pool = ThreadPool(0, threads, 'dman-verify')
+        self.buffer_size = buffer_size
+        self.__started = False
+
+    def verify(self, path, expected):
+        """Check the file at path, returns a Deferred that fires with
+        None if it matches expected or an error message"""
+        if not self.__started:
+            self.__started = True
+            self.pool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown', self.pool.stop)
+        return deferToThreadPool(reactor, self.pool, check_file, path,
+                expected, self.buffer_size)